@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Compares websync.hashing.file_etag with the original serial ETag code.
+
+    python benchmarks/bench_etag.py --sizes 1G,10G --dir /var/tmp
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from functools import reduce
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from websync import hashing  # noqa: E402
+
+CHUNK_SIZE = 8388608
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def legacy_file_etag(filepath, chunk_size=CHUNK_SIZE):
+    """ETag implementation used by BucketManager before hashing.py."""
+    hashes = []
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h = md5()
+            h.update(data)
+            hashes.append(h)
+    if not hashes:
+        return
+    elif len(hashes) == 1:
+        return '"{}"'.format(hashes[0].hexdigest())
+    h = md5(reduce(lambda x, y: x + y, (h.digest() for h in hashes)))
+    return '"{}-{}"'.format(h.hexdigest(), len(hashes))
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def make_file(directory, size):
+    block = os.urandom(64 << 20)
+    fd, path = tempfile.mkstemp(prefix='websync-bench-', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        remaining = size
+        while remaining:
+            n = min(remaining, len(block))
+            f.write(block[:n])
+            remaining -= n
+    return path
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1G,10G',
+                        help='Comma separated file sizes, e.g. 64M,1G,10G')
+    parser.add_argument('--dir', default=None,
+                        help='Directory for the generated files.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"size":>8} {"impl":>10} {"best s":>8} {"MiB/s":>8}')
+    for text in args.sizes.split(','):
+        size = parse_size(text)
+        path = make_file(args.dir, size)
+        try:
+            impls = [
+                ('legacy', legacy_file_etag, (path,), {}),
+                ('serial', hashing.file_etag, (path, CHUNK_SIZE),
+                 {'threshold': CHUNK_SIZE, 'parallel': False}),
+                ('parallel', hashing.file_etag, (path, CHUNK_SIZE),
+                 {'threshold': CHUNK_SIZE, 'parallel': True}),
+            ]
+            etags = set()
+            for name, func, func_args, func_kwargs in impls:
+                best = None
+                for _ in range(args.repeat):
+                    etag, elapsed = timed(func, *func_args, **func_kwargs)
+                    best = elapsed if best is None else min(best, elapsed)
+                etags.add(etag)
+                print(f'{text:>8} {name:>10} {best:8.2f} '
+                      f'{size / (1 << 20) / best:8.0f}')
+            if len(etags) != 1:
+                sys.exit(f'ETag mismatch for {text}: {etags}')
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Checks that the websync CLI starts quickly.
+
+Runs each command in a fresh interpreter with -X importtime, fails if
+boto3 or botocore are imported or if the best time is over budget.
+Python 3.6 ignores -X importtime, so there only run times are checked.
+
+    python benchmarks/bench_startup.py --import-budget 100 --run-budget 300
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+COMMANDS = (
+    ['--help'],
+    ['sync-bucket', '--help'],
+    ['deploy-fleet', '--help'],
+)
+
+# Modules a command must not import before it talks to AWS.
+HEAVY_MODULES = ('boto3', 'botocore', 's3transfer', 'aiobotocore')
+
+
+def run(args):
+    """Returns (wall seconds, {module: cumulative us}) for one CLI run."""
+    code = ('import sys; from websync.main import cli; '
+            'cli(sys.argv[1:], prog_name="websync")')
+    env = dict(os.environ, PYTHONPATH=SRC)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env,
+        universal_newlines=True, check=True)
+    elapsed = time.perf_counter() - start
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--import-budget', type=float, default=100,
+                        help='Milliseconds allowed to import websync.main.')
+    parser.add_argument('--run-budget', type=float, default=300,
+                        help='Milliseconds allowed per command, '
+                             'including interpreter startup.')
+    args = parser.parse_args()
+
+    failures = []
+    print(f'{"command":<24} {"import ms":>10} {"run ms":>8}')
+    for command in COMMANDS:
+        best_run = best_import = None
+        for _ in range(args.repeat):
+            elapsed, modules = run(command)
+            heavy = sorted(m for m in modules if m.split('.')[0] in HEAVY_MODULES)
+            if heavy:
+                failures.append(f'{" ".join(command)} imports {heavy[0]}')
+            imported = modules.get('websync.main', 0) / 1000
+            best_run = elapsed if best_run is None else min(best_run, elapsed)
+            best_import = imported if best_import is None else min(best_import, imported)
+        name = ' '.join(command)
+        print(f'{name:<24} {best_import:10.1f} {best_run * 1000:8.1f}')
+        if best_import > args.import_budget:
+            failures.append(f'{name}: import took {best_import:.1f} ms')
+        if best_run * 1000 > args.run_budget:
+            failures.append(f'{name}: run took {best_run * 1000:.1f} ms')
+
+    if failures:
+        sys.exit('Startup budget exceeded:\n' + '\n'.join(sorted(set(failures))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks sync_bucket, get_file_etag and set_bucket_manifest against a
+local moto S3 server (pip install 'moto[server]').
+
+Synthetic site trees are generated from a fixed seed, so runs on the same
+--scale are comparable across commits.  For each tree the bucket is synced
+cold (empty bucket), warm (nothing changed, ETag cache warm), warm without
+the ETag cache, and after a partial change.  Every measurement runs in its
+own process so peak RSS belongs to that step alone; the S3 server runs in
+a separate process too.
+
+    python benchmarks/bench_sync.py --scale 0.1 --out results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+SEED = 20191003
+
+# name: (files, file size, directory fan out, nesting depth) at scale 1.
+# --scale multiplies the number of files, or the size of the huge files.
+TREES = {
+    'tiny': (5000, 1024, 50, 2),
+    'huge': (4, 64 << 20, 1, 1),
+    'deep': (1000, 16 << 10, 2, 20),
+}
+# Huge files stay multipart at any scale.
+MIN_HUGE_SIZE = 16 << 20
+BLOCK_SIZE = 1 << 20
+
+STEPS = ('cold', 'warm', 'warm-nocache', 'partial', 'etag', 'manifest')
+
+
+def make_tree(root, files, size, fanout, depth, rng):
+    """Writes files of size bytes spread over fanout ** depth directories.
+    Returns the list of relative paths."""
+    paths = []
+    block = random_bytes(rng, min(max(size, 1), BLOCK_SIZE))
+    for i in range(files):
+        parts = []
+        n = i
+        for _ in range(depth):
+            parts.append(f'd{n % fanout}')
+            n //= fanout
+        rel = os.path.join(*parts, f'f{i}.html')
+        write_file(os.path.join(root, rel), block, size, i)
+        paths.append(rel)
+    return paths
+
+
+def random_bytes(rng, n):
+    """Returns n bytes from rng, like Random.randbytes (Python 3.9+)."""
+    return rng.getrandbits(n * 8).to_bytes(n, 'little')
+
+
+def write_file(path, block, size, salt):
+    """Writes size bytes made unique by salt."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    prefix = f'{salt}:'.encode()
+    with open(path, 'wb') as f:
+        f.write(prefix[:size])
+        remaining = size - min(len(prefix), size)
+        while remaining:
+            n = min(remaining, len(block))
+            f.write(block[:n])
+            remaining -= n
+
+
+def change_tree(root, paths, size, rng):
+    """Rewrites every 10th file, removes every 100th and adds 1% new files.
+    Returns the new list of paths."""
+    block = random_bytes(rng, min(max(size, 1), BLOCK_SIZE))
+    kept = []
+    for i, rel in enumerate(paths):
+        if i % 100 == 99:
+            os.remove(os.path.join(root, rel))
+            continue
+        if i % 10 == 0:
+            write_file(os.path.join(root, rel), block, size, -i - 1)
+        kept.append(rel)
+    for i in range(max(1, len(paths) // 100)):
+        rel = os.path.join('new', f'n{i}.html')
+        write_file(os.path.join(root, rel), block, size, len(paths) + i)
+        kept.append(rel)
+    return kept
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server():
+    """Starts moto's S3 server in a child process.  Returns (process, url)."""
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'moto.server', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, f'http://127.0.0.1:{port}'
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit('moto server did not start; pip install "moto[server]"')
+
+
+def worker(spec):
+    """Runs one step in this process and prints its results as JSON."""
+    import boto3
+    from websync import config
+    from websync.etagcache import EtagCache
+    from websync.metrics import Metrics
+    from websync.s3bucket import BucketManager
+
+    settings = dict(config.DEFAULTS, max_pool_connections=spec['jobs'])
+    metrics = Metrics()
+    etag_cache = EtagCache(spec['etag_db'], rehash=spec['rehash'])
+    bucket_manager = BucketManager(
+        boto3.Session(region_name='us-east-1'),
+        etag_cache=etag_cache,
+        endpoint_url=spec['url'],
+        config=config.get_client_config(settings),
+        transfer_config=config.get_transfer_config(settings),
+        metrics=metrics
+    )
+    step = spec['step']
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    start = time.perf_counter()
+    try:
+        if step == 'etag':
+            for directory, _, names in os.walk(spec['root']):
+                for name in names:
+                    bucket_manager.get_file_etag(os.path.join(directory, name))
+            etag_cache.save()
+        elif step == 'manifest':
+            bucket_manager.set_bucket_manifest(spec['bucket'])
+        else:
+            bucket_manager.sync_bucket(spec['root'], spec['bucket'], spec['jobs'])
+    finally:
+        elapsed = time.perf_counter() - start
+        sys.stdout = stdout
+        etag_cache.close()
+
+    requests = {}
+    files = {}
+    for metric in metrics.snapshot():
+        if metric['name'] == 'api_requests':
+            requests[metric['labels']['operation']] = metric['value']
+        elif metric['type'] == 'counter' and not metric['labels']:
+            files[metric['name']] = metric['value']
+    print(json.dumps({
+        'wall_s': round(elapsed, 4),
+        'peak_rss_mib': round(peak_rss() / (1 << 20), 1),
+        'requests': requests,
+        'request_count': sum(requests.values()),
+        'counters': files,
+    }))
+
+
+def peak_rss():
+    """Returns peak resident bytes of this process."""
+    # On Linux ru_maxrss keeps the parent's peak across fork and exec, so
+    # read the high water mark of this process's own memory instead.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and KiB elsewhere.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_step(spec):
+    env = dict(os.environ, PYTHONPATH=SRC, AWS_ACCESS_KEY_ID='bench',
+               AWS_SECRET_ACCESS_KEY='bench', AWS_DEFAULT_REGION='us-east-1')
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(spec)],
+        stdout=subprocess.PIPE, env=env, universal_newlines=True,
+        check=True)
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def git_commit():
+    root = os.path.join(SRC, '..')
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=root, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the number of files in each tree, '
+                             'or the size of the huge files.')
+    parser.add_argument('--trees', default=','.join(TREES),
+                        help='Comma separated trees: ' + ', '.join(TREES))
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--dir', default=None,
+                        help='Directory for the generated trees.')
+    parser.add_argument('--out', default=None,
+                        help='Results file [default: bench-sync-<commit>.json].')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return worker(json.loads(args.worker))
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'jobs': args.jobs,
+        'runs': [],
+    }
+    workdir = tempfile.mkdtemp(prefix='websync-bench-', dir=args.dir)
+    server, url = start_server()
+    print(f'{"tree":<6} {"step":<13} {"files":>6} {"MiB":>8} {"wall s":>8} '
+          f'{"MiB/s":>8} {"files/s":>8} {"RSS MiB":>8} {"requests":>9}')
+    try:
+        import boto3
+        s3 = boto3.client('s3', endpoint_url=url, region_name='us-east-1',
+                          aws_access_key_id='bench',
+                          aws_secret_access_key='bench')
+        for name in args.trees.split(','):
+            files, size, fanout, depth = TREES[name]
+            if name == 'huge':
+                size = max(MIN_HUGE_SIZE, int(size * args.scale))
+            else:
+                files = max(1, int(files * args.scale))
+            rng = random.Random(f'{SEED}-{name}')
+            root = os.path.join(workdir, name)
+            paths = make_tree(root, files, size, fanout, depth, rng)
+            bucket = f'bench-{name}'
+            s3.create_bucket(Bucket=bucket)
+            etag_db = os.path.join(workdir, f'{name}-etags.db')
+
+            for step in STEPS:
+                if step == 'partial':
+                    paths = change_tree(root, paths, size, rng)
+                spec = {
+                    'step': step,
+                    'url': url,
+                    'root': root,
+                    'bucket': bucket,
+                    'jobs': args.jobs,
+                    'etag_db': etag_db,
+                    'rehash': step in ('warm-nocache', 'etag'),
+                }
+                run = run_step(spec)
+                nbytes = len(paths) * size
+                run.update({
+                    'tree': name,
+                    'step': step,
+                    'files': len(paths),
+                    'bytes': nbytes,
+                    'mib_per_s': round(nbytes / (1 << 20) / run['wall_s'], 2),
+                    'files_per_s': round(len(paths) / run['wall_s'], 1),
+                })
+                results['runs'].append(run)
+                print(f'{name:<6} {step:<13} {len(paths):>6} '
+                      f'{nbytes / (1 << 20):8.1f} {run["wall_s"]:8.2f} '
+                      f'{run["mib_per_s"]:8.1f} {run["files_per_s"]:8.0f} '
+                      f'{run["peak_rss_mib"]:8.1f} {run["request_count"]:9}')
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    out = args.out or f'bench-sync-{(commit or "unknown")[:12]}.json'
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote {out}')
+
+
+if __name__ == '__main__':
+    main()
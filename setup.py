@@ -15,6 +15,12 @@ setup(
         'boto3',
         'click'
     ],
+    extras_require={
+        'aio': ['aiobotocore'],
+        'brotli': ['brotli'],
+        'fleet': ['PyYAML'],
+        'watch': ['watchdog'],
+    },
     entry_points={
         'console_scripts': [
         'websync=websync.main:cli'
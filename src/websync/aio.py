@@ -0,0 +1,440 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Asyncio backend for bucket operations.
+
+Requires aiobotocore.  Every request goes through one client whose
+connection pool is sized to the number of requests kept in flight.
+"""
+
+import asyncio
+import os
+import random
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+from websync import hashing, planner
+from websync.metrics import Metrics
+from websync.s3bucket import BucketManager
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import AioSession
+except ImportError:
+    AioSession = None
+
+
+async def plan(local, remote):
+    """Async counterpart of planner.plan for an async remote iterator."""
+    local = iter(local)
+    remote = remote.__aiter__()
+
+    async def next_remote():
+        try:
+            return await remote.__anext__()
+        except StopAsyncIteration:
+            return None, None
+
+    lkey, path = next(local, (None, None))
+    rkey, etag = await next_remote()
+    while lkey is not None or rkey is not None:
+        if rkey is None or (lkey is not None and lkey < rkey):
+            yield planner.Action(planner.UPLOAD, lkey, path, None)
+            lkey, path = next(local, (None, None))
+        elif lkey is None or rkey < lkey:
+            yield planner.Action(planner.DELETE, rkey, None, etag)
+            rkey, etag = await next_remote()
+        else:
+            yield planner.Action(planner.UPDATE, lkey, path, etag)
+            lkey, path = next(local, (None, None))
+            rkey, etag = await next_remote()
+
+
+class AsyncBucketManager:
+    """Asyncio versions of BucketManager's bucket operations.
+
+        async with AsyncBucketManager(profile) as mgr:
+            await mgr.sync_bucket(pathname, bucket)
+    """
+
+    DELETE_BATCH_SIZE = BucketManager.DELETE_BATCH_SIZE
+    DELETE_MAX_ATTEMPTS = BucketManager.DELETE_MAX_ATTEMPTS
+    RETRY_ERROR_CODES = BucketManager.RETRY_ERROR_CODES
+
+    prepare_upload = BucketManager.prepare_upload
+
+    def __init__(self, profile=None, endpoint_url=None, etag_cache=None,
+                 max_requests=100, transfer_config=None, compressor=None,
+                 cache_policy=None, metrics=None):
+        if AioSession is None:
+            raise ImportError(
+                'The aio backend requires aiobotocore: pip install aiobotocore')
+        self.session = AioSession(profile=profile)
+        self.endpoint_url = endpoint_url
+        self.etag_cache = etag_cache
+        self.compressor = compressor
+        self.cache_policy = cache_policy
+        self.metrics = metrics or Metrics()
+        self.max_requests = max_requests
+        self.chunk_size = BucketManager.CHUNK_SIZE
+        self.threshold = BucketManager.CHUNK_SIZE
+        if transfer_config is not None:
+            self.chunk_size = transfer_config.multipart_chunksize
+            self.threshold = transfer_config.multipart_threshold
+        self.client = None
+        self.manifest = {}
+
+    async def __aenter__(self):
+        self.client_context = self.session.create_client(
+            's3',
+            endpoint_url=self.endpoint_url,
+            config=AioConfig(max_pool_connections=self.max_requests)
+        )
+        self.client = await self.client_context.__aenter__()
+        self.metrics.instrument(self.client)
+        self.requests = asyncio.Semaphore(self.max_requests)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client_context.__aexit__(*exc_info)
+        self.client = None
+
+    async def all_objects(self, bucket_name):
+        """Yields (key, etag) for all objects in s3 bucket."""
+        paginator = self.client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=bucket_name):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].startswith(planner.STATE_PREFIX):
+                    yield obj['Key'], obj['ETag']
+
+    async def set_bucket_manifest(self, bucket):
+        """Loads manifest for caching purposes."""
+        async for key, etag in self.all_objects(bucket):
+            self.manifest[key] = etag
+
+    async def get_file_etag(self, filepath):
+        """Gets etag for a file without blocking the event loop."""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, hashing.cached_file_etag,
+            filepath, self.chunk_size, self.threshold, self.etag_cache
+        )
+
+    @staticmethod
+    async def read_file(path, offset=0, size=None):
+        """Reads size bytes of path at offset without blocking the loop."""
+        def read():
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read(-1 if size is None else size)
+        return await asyncio.get_event_loop().run_in_executor(None, read)
+
+    async def file_upload(self, bucket_name, path, key, remote_etag=None):
+        """Uploads file to s3 bucket at key unless it is already there.
+        Returns True if the object was written."""
+        path, extra_args = await asyncio.get_event_loop().run_in_executor(
+            None, self.prepare_upload, path, key)
+        with self.metrics.timer('hash'):
+            etag = await self.get_file_etag(path)
+        if remote_etag is None:
+            remote_etag = self.manifest.get(key, '')
+        if remote_etag == etag:
+            if self.cache_policy is not None and not await self.headers_current(
+                    bucket_name, key, etag, extra_args):
+                print(f'Updating metadata of {key} in {bucket_name}')
+                await self.update_metadata(
+                    bucket_name, key, extra_args, os.path.getsize(path))
+                self.record_headers(bucket_name, key, etag, extra_args)
+                self.metrics.incr('metadata_updates')
+                return True
+            print(f'Skipping {key} already exists in {bucket_name}')
+            return False
+        print(f'Uploading {key} to {bucket_name} bucket.')
+        size = os.path.getsize(path)
+        with self.metrics.timer('upload'):
+            if size < self.threshold:
+                body = await self.read_file(path)
+                async with self.requests:
+                    await self.client.put_object(
+                        Bucket=bucket_name, Key=key, Body=body, **extra_args
+                    )
+            else:
+                await self.multipart_upload(bucket_name, path, key, extra_args)
+        self.metrics.incr('bytes_uploaded', size)
+        self.record_headers(bucket_name, key, etag, extra_args)
+        return True
+
+    def record_headers(self, bucket_name, key, etag, extra_args):
+        """Remembers the headers written to key in the ETag cache."""
+        if self.etag_cache is not None:
+            self.etag_cache.set_headers(
+                bucket_name, key, etag, BucketManager.headers_digest(extra_args))
+
+    async def headers_current(self, bucket_name, key, etag, extra_args):
+        """Returns True if object key has the headers extra_args would set,
+        asking s3 only if the ETag cache does not know."""
+        if self.etag_cache is not None and self.etag_cache.get_headers(
+                bucket_name, key, etag) == BucketManager.headers_digest(
+                    extra_args):
+            return True
+        if await self.metadata_changed(bucket_name, key, extra_args):
+            return False
+        self.record_headers(bucket_name, key, etag, extra_args)
+        return True
+
+    async def metadata_changed(self, bucket_name, key, extra_args):
+        """Returns True if the headers of object key differ from the ones
+        extra_args would set."""
+        async with self.requests:
+            head = await self.client.head_object(Bucket=bucket_name, Key=key)
+        return any(
+            head.get(name) != extra_args.get(name)
+            for name in BucketManager.METADATA_ARGS
+        )
+
+    async def update_metadata(self, bucket_name, key, extra_args, size):
+        """Replaces headers of object key by copying it onto itself.
+        Objects of multipart_threshold or more are copied in parts sized
+        like their upload, which keeps the ETag and works above 5 GB."""
+        if size >= self.threshold:
+            await self.multipart_copy(bucket_name, key, extra_args, size)
+            return
+        async with self.requests:
+            await self.client.copy_object(
+                Bucket=bucket_name, Key=key,
+                CopySource={'Bucket': bucket_name, 'Key': key},
+                MetadataDirective='REPLACE', **extra_args
+            )
+
+    async def multipart_copy(self, bucket_name, key, extra_args, size):
+        """Copies object key onto itself with UploadPartCopy, several parts
+        at a time."""
+        chunk_size = hashing.part_size(size, self.chunk_size)
+        upload_id = (await self.client.create_multipart_upload(
+            Bucket=bucket_name, Key=key, **extra_args
+        ))['UploadId']
+
+        async def copy_part(number, offset):
+            last = min(offset + chunk_size, size) - 1
+            async with self.requests:
+                response = await self.client.upload_part_copy(
+                    Bucket=bucket_name, Key=key, UploadId=upload_id,
+                    PartNumber=number,
+                    CopySource={'Bucket': bucket_name, 'Key': key},
+                    CopySourceRange=f'bytes={offset}-{last}'
+                )
+            return {
+                'PartNumber': number,
+                'ETag': response['CopyPartResult']['ETag']
+            }
+
+        offsets = range(0, size, chunk_size)
+        try:
+            parts = await asyncio.gather(*(
+                copy_part(number, offset)
+                for number, offset in enumerate(offsets, 1)
+            ))
+            await self.client.complete_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            await self.client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    async def multipart_upload(self, bucket_name, path, key, extra_args):
+        """Uploads file in parts, several parts at a time.  Parts are
+        sized as s3transfer would so the ETag matches get_file_etag."""
+        size = os.path.getsize(path)
+        chunk_size = hashing.part_size(size, self.chunk_size)
+        upload_id = (await self.client.create_multipart_upload(
+            Bucket=bucket_name, Key=key, **extra_args
+        ))['UploadId']
+
+        async def upload_part(number, offset):
+            async with self.requests:
+                body = await self.read_file(path, offset, chunk_size)
+                response = await self.client.upload_part(
+                    Bucket=bucket_name, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=body
+                )
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        offsets = range(0, size, chunk_size)
+        try:
+            parts = await asyncio.gather(*(
+                upload_part(number, offset)
+                for number, offset in enumerate(offsets, 1)
+            ))
+            await self.client.complete_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            await self.client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    async def delete_batch(self, bucket_name, keys):
+        """Deletes up to DELETE_BATCH_SIZE keys, retrying throttled keys.
+        Returns (deleted count, list of (key, error))."""
+        deleted = 0
+        failed = []
+        for attempt in range(self.DELETE_MAX_ATTEMPTS):
+            try:
+                async with self.requests:
+                    response = await self.client.delete_objects(
+                        Bucket=bucket_name,
+                        Delete={
+                            'Objects': [{'Key': k} for k in keys],
+                            'Quiet': True
+                        }
+                    )
+                errors = [
+                    (e['Key'], e['Code'], e.get('Message', ''))
+                    for e in response.get('Errors', [])
+                ]
+            except ClientError as e:
+                error = e.response['Error']
+                errors = [
+                    (k, error['Code'], error.get('Message', '')) for k in keys
+                ]
+            deleted += len(keys) - len(errors)
+            keys = []
+            for key, code, message in errors:
+                if code in self.RETRY_ERROR_CODES:
+                    keys.append(key)
+                else:
+                    failed.append((key, f'{code}: {message}'))
+            if not keys:
+                break
+            if attempt + 1 < self.DELETE_MAX_ATTEMPTS:
+                await asyncio.sleep(
+                    min(20, 0.2 * 2 ** attempt) * random.uniform(0.5, 1))
+        failed.extend((key, 'Retries exhausted') for key in keys)
+        return deleted, failed
+
+    async def delete_keys(self, bucket_name, keys):
+        """Deletes keys from s3 bucket in concurrent batches.
+        Returns a list of (key, error) for keys that could not be deleted."""
+        keys = list(keys)
+        with self.metrics.timer('delete'):
+            results = await asyncio.gather(*(
+                self.delete_batch(bucket_name, keys[i:i + self.DELETE_BATCH_SIZE])
+                for i in range(0, len(keys), self.DELETE_BATCH_SIZE)
+            ))
+        deleted = sum(count for count, _ in results)
+        self.metrics.incr('files_deleted', deleted)
+        failed = [error for _, errors in results for error in errors]
+        for key, error in failed:
+            print(f'Failed to remove {key} from {bucket_name}: {error}')
+        print(f'Removed {deleted} object(s) from {bucket_name}, '
+              f'{len(failed)} failed.')
+        return failed
+
+    async def get_bucket_tags(self, bucket_name):
+        """Lists all tags for a specified bucket."""
+        try:
+            response = await self.client.get_bucket_tagging(Bucket=bucket_name)
+        except ClientError:
+            print(f'{bucket_name} does not have any tags set.')
+            return []
+        for t in response['TagSet']:
+            print(f"{t['Key']}: {t['Value']}")
+        return response['TagSet']
+
+    async def set_bucket_tag(self, bucket_name, key='Creator', value='Web-Sync'):
+        """Tags specified s3 bucket."""
+        try:
+            response = await self.client.get_bucket_tagging(Bucket=bucket_name)
+            tags = [t for t in response['TagSet'] if t['Key'] != key]
+        except ClientError:
+            tags = []
+        tags.append({'Key': key, 'Value': value})
+        await self.client.put_bucket_tagging(
+            Bucket=bucket_name, Tagging={'TagSet': tags})
+
+    async def remove_bucket_tag(self, bucket_name, key, value=None):
+        """Removes tag from specified s3 bucket."""
+        try:
+            response = await self.client.get_bucket_tagging(Bucket=bucket_name)
+        except ClientError:
+            print(f'{bucket_name} does not appear to have a {key} tag set.')
+            return
+        tags = [t for t in response['TagSet'] if t['Key'] != key]
+        await self.client.put_bucket_tagging(
+            Bucket=bucket_name, Tagging={'TagSet': tags})
+
+    async def set_bucket_policy(self, bucket_name):
+        """Sets bucket policy for *.html to be public."""
+        await self.client.put_bucket_policy(
+            Bucket=bucket_name,
+            Policy=BucketManager.public_bucket_policy(bucket_name)
+        )
+
+    async def clear_state_marker(self, bucket_name):
+        """Removes the state marker if there is one; deleting a missing key
+        would still add a delete marker to a versioned bucket."""
+        try:
+            await self.client.head_object(
+                Bucket=bucket_name, Key=planner.STATE_KEY)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return
+        await self.client.delete_object(
+            Bucket=bucket_name, Key=planner.STATE_KEY)
+
+    async def sync_bucket(self, pathname, bucket, jobs=100):
+        """Sync contents of pathname to s3 bucket with up to `jobs` files
+        in flight.  Returns a SyncResult."""
+        root = Path(pathname).expanduser().resolve()
+        # This sync does not keep the manifest snapshot up to date.
+        await self.clear_state_marker(bucket)
+        slots = asyncio.Semaphore(max(jobs, 1))
+        pending = set()
+        del_list = []
+        result = planner.SyncResult()
+
+        async def upload(path, key, remote_etag):
+            try:
+                if await self.file_upload(bucket, path, key, remote_etag):
+                    result.uploaded.append(key)
+                    self.metrics.incr('files_uploaded')
+                else:
+                    result.skipped += 1
+                    self.metrics.incr('files_skipped')
+            except Exception as e:
+                print(f'Failed to upload {key} to {bucket}: {e}')
+                result.failed.append((key, e))
+                self.metrics.incr('files_failed')
+            finally:
+                slots.release()
+
+        with self.metrics.timer('uploads'):
+            local = self.metrics.timed_iter('walk', planner.walk_local(root))
+            async for action in plan(local, self.all_objects(bucket)):
+                if action.kind == planner.DELETE:
+                    del_list.append(action.key)
+                    continue
+                # A key the bucket lacks gets '', not the manifest's ETag.
+                remote_etag = '' if action.kind == planner.UPLOAD \
+                    else action.etag
+                await slots.acquire()
+                task = asyncio.ensure_future(
+                    upload(action.path, action.key, remote_etag))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending)
+
+        if del_list:
+            [print(f'Removing {key} from {bucket}') for key in del_list]
+            failed = await self.delete_keys(bucket, del_list)
+            failed_keys = {key for key, _ in failed}
+            result.deleted = [k for k in del_list if k not in failed_keys]
+            result.failed.extend(failed)
+        else:
+            print('It does not appear that any files need to be removed.')
+        if self.etag_cache is not None:
+            self.etag_cache.save()
+        return result
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Rule based Cache-Control headers for uploaded objects."""
+
+from fnmatch import fnmatchcase
+
+
+class CachePolicy:
+    """Maps keys to Cache-Control values with ordered glob rules.
+
+    Rules are (pattern, value) pairs matched against the whole key with
+    fnmatch, so '*' also matches '/'.  The first matching rule wins; keys
+    that match no rule get no Cache-Control header.
+
+        CachePolicy([
+            ('imgs/*', 'public, max-age=31536000, immutable'),
+            ('*.html', 'public, max-age=300'),
+        ])
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    @classmethod
+    def from_specs(cls, specs):
+        """Builds policy from 'PATTERN=VALUE' strings."""
+        rules = []
+        for spec in specs:
+            pattern, sep, value = spec.partition('=')
+            if not sep or not pattern.strip():
+                raise ValueError(f'Cache-Control rule must be PATTERN=VALUE: {spec}')
+            rules.append((pattern.strip(), value.strip()))
+        return cls(rules)
+
+    def get(self, key):
+        """Returns Cache-Control value for key or None."""
+        for pattern, value in self.rules:
+            if fnmatchcase(key, pattern):
+                return value
+        return None
@@ -1,33 +1,130 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import boto3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from websync import utils
+from websync.metrics import Metrics
 
 """Classes to manage SSL Certificates."""
 
 
 class CertificateManager:
     """Manage an ACM Certificate"""
-    def __init__(self, session):
+    def __init__(self, session, config=None, cache_ttl=0, jobs=8,
+                 metrics=None):
         self.session = session
-        self.client = self.session.client('acm', region_name='us-east-1')
+        self.client = self.session.client(
+            'acm', region_name='us-east-1', config=config)
+        self.metrics = metrics or Metrics()
+        self.metrics.instrument(self.client)
+        self.cache_ttl = cache_ttl
+        self.jobs = jobs
+        self.certificates = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def name_matches(name, domain_name):
+        """Returns True if certificate name covers domain name exactly or
+        as a wildcard for exactly one more label."""
+        name = name.lower()
+        domain_name = domain_name.lower().rstrip('.')
+        if name == domain_name:
+            return True
+        if name.startswith('*.') and '.' in domain_name:
+            label, parent = domain_name.split('.', 1)
+            return bool(label) and name[2:] == parent
+        return False
 
     def cert_matches(self, cert_arn, domain_name):
         """Returns True if certificate san matches exactly or is a * match"""
         cert_info = self.client.describe_certificate(CertificateArn=cert_arn)
         alt_names = cert_info['Certificate']['SubjectAlternativeNames']
-        for name in alt_names:
-            if name == domain_name:
-                return True
-            elif name[0] == '*' and domain_name.endswith(name[1:]):
-                return True
-        return False
+        return any(self.name_matches(name, domain_name) for name in alt_names)
+
+    def get_cache_name(self):
+        return f'certificates-{self.session.profile_name or "default"}.json'
+
+    def describe_names(self, cert_arn):
+        """Returns (names, expiry timestamp) from describe_certificate."""
+        cert = self.client.describe_certificate(
+            CertificateArn=cert_arn)['Certificate']
+        not_after = cert.get('NotAfter')
+        return (
+            cert['SubjectAlternativeNames'],
+            not_after.timestamp() if not_after else None
+        )
+
+    def load_certificates(self, refresh=False):
+        """Returns index of lower cased name -> issued certificates.
+
+        SAN lists returned by list_certificates are used as is; certificates
+        with more names than the listing includes are described
+        concurrently.  The index is built once per run, or read from the
+        on-disk cache while it is younger than cache_ttl seconds.
+        """
+        with self.lock:
+            if self.certificates is not None and not refresh:
+                return self.certificates
+            if not refresh:
+                cached = utils.read_json_cache(
+                    self.get_cache_name(), self.cache_ttl)
+                if cached is not None:
+                    self.certificates = cached
+                    return cached
+
+            certs = []
+            paginator = self.client.get_paginator('list_certificates')
+            with self.metrics.timer('list_certificates'):
+                for page in paginator.paginate(CertificateStatuses=['ISSUED']):
+                    for summary in page['CertificateSummaryList']:
+                        not_after = summary.get('NotAfter')
+                        certs.append({
+                            'CertificateArn': summary['CertificateArn'],
+                            'DomainName': summary['DomainName'],
+                            'SubjectAlternativeNames': summary.get(
+                                'SubjectAlternativeNameSummaries'),
+                            'NotAfter': not_after.timestamp() if not_after else None,
+                            'Complete': not summary.get(
+                                'HasAdditionalSubjectAlternativeNames', False),
+                        })
+
+            incomplete = [
+                cert for cert in certs
+                if cert['SubjectAlternativeNames'] is None
+                or not cert['Complete']
+            ]
+            with self.metrics.timer('describe_certificates'), \
+                    ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                described = executor.map(
+                    self.describe_names,
+                    [cert['CertificateArn'] for cert in incomplete]
+                )
+                for cert, (names, not_after) in zip(incomplete, described):
+                    cert['SubjectAlternativeNames'] = names
+                    cert['NotAfter'] = not_after or cert['NotAfter']
+
+            index = {}
+            for cert in certs:
+                del cert['Complete']
+                for name in cert['SubjectAlternativeNames']:
+                    index.setdefault(name.lower(), []).append(cert)
+            self.certificates = index
+            if self.cache_ttl:
+                utils.write_json_cache(self.get_cache_name(), index)
+            return index
 
     def get_matching_certificates(self, domain_name):
-        """Lists matching certificates for domain in ACM."""
-        paginator = self.client.get_paginator('list_certificates')
-        for page in paginator.paginate(CertificateStatuses=['ISSUED']):
-            for cert in page['CertificateSummaryList']:
-                        if self.cert_matches(cert['CertificateArn'], domain_name):
-                            return cert
+        """Returns an unexpired issued certificate for domain in ACM, matching
+        exactly or by a single level wildcard, or None."""
+        index = self.load_certificates()
+        domain_name = domain_name.lower().rstrip('.')
+        candidates = list(index.get(domain_name, []))
+        if '.' in domain_name:
+            candidates += index.get('*.' + domain_name.split('.', 1)[1], [])
+        now = time.time()
+        for cert in candidates:
+            if cert['NotAfter'] is None or cert['NotAfter'] > now:
+                return cert
         return None
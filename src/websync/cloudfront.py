@@ -1,16 +1,71 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import threading
 import uuid
-import boto3
+from collections import Counter
+from urllib.parse import quote
+from websync import utils
+from websync.metrics import Metrics
 
 
 
 class CloudFrontManager:
     """Classes to manage CloudFront Distributions."""
-    def __init__(self, session):
+
+    # The first 1000 invalidation paths each month are free.
+    MAX_INVALIDATION_PATHS = 100
+    # CloudFront allows 15 wildcard paths in progress per distribution.
+    MAX_INVALIDATION_WILDCARDS = 15
+    INDEX_DOCUMENT = 'index.html'
+
+    def __init__(self, session, config=None, cache_ttl=0, metrics=None):
         self.session = session
-        self.client = self.session.client('cloudfront')
+        self.client = self.session.client('cloudfront', config=config)
+        self.metrics = metrics or Metrics()
+        self.metrics.instrument(self.client)
+        self.cache_ttl = cache_ttl
+        self.distributions = None
+        self.origin_access_identities = None
+        self.lock = threading.Lock()
+
+    def get_cache_name(self):
+        return f'distributions-{self.session.profile_name or "default"}.json'
+
+    def load_distributions(self, refresh=False):
+        """Returns index of lower cased alias -> distribution summary.
+        It is listed once per run, or read from the on-disk cache when
+        cache_ttl is set and the cache is younger than cache_ttl seconds."""
+        with self.lock:
+            if self.distributions is not None and not refresh:
+                return self.distributions
+            if not refresh:
+                cached = utils.read_json_cache(
+                    self.get_cache_name(), self.cache_ttl)
+                if cached is not None:
+                    self.distributions = cached
+                    return cached
+
+            index = {}
+            paginator = self.client.get_paginator('list_distributions')
+            with self.metrics.timer('list_distributions'):
+                for page in paginator.paginate():
+                    for item in page['DistributionList'].get('Items', []):
+                        for alias in item['Aliases'].get('Items', []):
+                            index[alias.lower()] = item
+            self.distributions = index
+            if self.cache_ttl:
+                utils.write_json_cache(self.get_cache_name(), index)
+            return index
+
+    def add_distribution(self, dist):
+        """Adds a new distribution to the alias index."""
+        index = self.load_distributions()
+        aliases = dist['DistributionConfig']['Aliases'].get('Items', [])
+        with self.lock:
+            for alias in aliases:
+                index[alias.lower()] = dist
+            utils.remove_json_cache(self.get_cache_name())
 
     def awaiting_deployment(self, dist):
         """Waits for distribution to be deployed."""
@@ -33,10 +88,9 @@ class CloudFrontManager:
         """
 
         origin_id = 'S3-' + domain_name
-        origin_access_id_config = self.get_origin_access_identity_config(domain_name)
+        origin_access_id = self.get_origin_access_identity(domain_name)
 
-        if origin_access_id_config:
-            origin_access_id = self.get_origin_access_identity(domain_name)
+        if origin_access_id:
             print(f'Origin Access ID: {origin_access_id}')
         else:
             origin_access_id = self.create_origin_access_identity(domain_name)
@@ -88,8 +142,11 @@ class CloudFrontManager:
                                 'Quantity': 0
                             }
                         },
+                        # MinTTL 0 lets Cache-Control set on upload decide
+                        # how long edges keep short lived objects.
                         'DefaultTTL': 86400,
-                        'MinTTL': 3600
+                        'MinTTL': 0,
+                        'MaxTTL': 31536000
                     },
                     'ViewerCertificate': {
                         'ACMCertificateArn': certificate['CertificateArn'],
@@ -107,51 +164,148 @@ class CloudFrontManager:
             }
         }
     )
+        self.add_distribution(result['Distribution'])
         return result['Distribution']
 
+    @staticmethod
+    def collapse_paths(paths, max_paths=MAX_INVALIDATION_PATHS,
+                       max_wildcards=MAX_INVALIDATION_WILDCARDS):
+        """Returns paths merged into directory wildcards until there are at
+        most max_paths paths and max_wildcards wildcards.  The deepest
+        directory holding two or more paths is merged first so as little
+        as possible beyond the given paths is invalidated."""
+        def parent(directory):
+            if directory == '/':
+                return None
+            return directory[:directory.rstrip('/').rindex('/') + 1]
+
+        def directories(path):
+            if path.endswith('/*'):
+                directory = parent(path[:-1])
+            else:
+                directory = path[:path.rindex('/') + 1]
+            while directory:
+                yield directory
+                directory = parent(directory)
+
+        paths = set(paths)
+        while len(paths) > max_paths or \
+                sum(p.endswith('*') for p in paths) > max_wildcards:
+            counts = Counter(d for p in paths for d in directories(p))
+            candidates = [
+                (d.count('/'), count, d)
+                for d, count in counts.items() if count > 1
+            ]
+            if not candidates:
+                return ['/*']
+            _, _, directory = max(candidates)
+            paths = {p for p in paths if not p.startswith(directory)}
+            paths.add(directory + '*')
+        return sorted(paths)
+
+    def get_invalidation_paths(self, keys, max_paths=MAX_INVALIDATION_PATHS):
+        """Returns CloudFront paths that cover the s3 keys given.
+        Index documents are also invalidated by their directory path."""
+        paths = set()
+        for key in keys:
+            path = '/' + quote(key, safe='/~')
+            paths.add(path)
+            if key == self.INDEX_DOCUMENT or \
+                    key.endswith('/' + self.INDEX_DOCUMENT):
+                paths.add(path[:-len(self.INDEX_DOCUMENT)])
+        return self.collapse_paths(paths, max_paths)
+
+    def invalidate_paths(self, domain_name, keys, wait=False,
+                         max_paths=MAX_INVALIDATION_PATHS):
+        """Invalidates s3 keys in the distribution matching domain name.
+        Returns the invalidation or None if nothing was submitted."""
+        dist = self.get_matching_distributions(domain_name)
+        if not dist:
+            print(f'No CloudFront distribution found for {domain_name}.')
+            return None
+        paths = self.get_invalidation_paths(keys, max_paths)
+        if not paths:
+            return None
+        invalidation = self.client.create_invalidation(
+            DistributionId=dist['Id'],
+            InvalidationBatch={
+                'Paths': {
+                    'Quantity': len(paths),
+                    'Items': paths
+                },
+                'CallerReference': str(uuid.uuid4())
+            }
+        )['Invalidation']
+        print(f'Invalidating {len(paths)} path(s) in {dist["Id"]}: '
+              f'{invalidation["Id"]}')
+        self.metrics.incr('invalidation_paths', len(paths))
+        if wait:
+            print('Waiting for invalidation to complete...')
+            waiter = self.client.get_waiter('invalidation_completed')
+            with self.metrics.timer('invalidation_wait'):
+                waiter.wait(DistributionId=dist['Id'], Id=invalidation['Id'])
+        return invalidation
+
     def create_origin_access_identity(self, domain_name):
         """Creates Origin Access ID."""
-        oai_id = self.client.create_cloud_front_origin_access_identity(
+        oai = self.client.create_cloud_front_origin_access_identity(
             CloudFrontOriginAccessIdentityConfig={
                 'CallerReference': str(uuid.uuid4()),
                 'Comment': domain_name
                 }
-        )
-        return oai_id['CloudFrontOriginAccessIdentity']['Id']
+        )['CloudFrontOriginAccessIdentity']
+        index = self.load_origin_access_identities()
+        with self.lock:
+            index[domain_name] = {
+                'Id': oai['Id'],
+                'S3CanonicalUserId': oai['S3CanonicalUserId'],
+                'Comment': domain_name
+            }
+        return oai['Id']
+
+    def load_origin_access_identities(self, refresh=False):
+        """Returns index of comment -> Origin Access ID summary.
+        Web-sync names an Origin Access ID after its domain in the comment.
+        All pages are listed once per run."""
+        with self.lock:
+            if self.origin_access_identities is not None and not refresh:
+                return self.origin_access_identities
+            index = {}
+            paginator = self.client.get_paginator(
+                'list_cloud_front_origin_access_identities')
+            for page in paginator.paginate():
+                oai_list = page['CloudFrontOriginAccessIdentityList']
+                for item in oai_list.get('Items', []):
+                    index.setdefault(item['Comment'], item)
+            self.origin_access_identities = index
+            return index
 
     def get_origin_access_identity(self, domain_name):
         """Returns Origin Access ID."""
-        oai_list = self.client.list_cloud_front_origin_access_identities()['CloudFrontOriginAccessIdentityList']['Items']
-        paginator = self.client.get_paginator('list_cloud_front_origin_access_identities')
-        for page in paginator.paginate():
-            for item in oai_list:
-                if domain_name == item['Comment']:
-                    return self.client.get_cloud_front_origin_access_identity(
-                        Id=item['Id']
-                        )['CloudFrontOriginAccessIdentity']['Id']
+        item = self.load_origin_access_identities().get(domain_name)
+        return item['Id'] if item else None
 
     def get_origin_access_identity_config(self, domain_name):
         """Returns Origin Access ID Config."""
-        oai_list = self.client.list_cloud_front_origin_access_identities()['CloudFrontOriginAccessIdentityList']['Items']
-        paginator = self.client.get_paginator('list_cloud_front_origin_access_identities')
-        for page in paginator.paginate():
-            for item in oai_list:
-                if domain_name == item['Comment']:
-                    return self.client.get_cloud_front_origin_access_identity_config(Id=item['Id'])
+        item = self.load_origin_access_identities().get(domain_name)
+        if item is None:
+            return None
+        return self.client.get_cloud_front_origin_access_identity_config(
+            Id=item['Id'])
 
     def get_matching_distributions(self, domain_name):
-        """List CloudFront distributions that matches specified domain name."""
-        paginator = self.client.get_paginator('list_distributions')
-        for page in paginator.paginate():
-
-            for item in page['DistributionList']['Items']:
-                aliases = str(item['Aliases']['Items'])
-                if domain_name in aliases:
-                    return item
-        return None
+        """Returns CloudFront distribution with an alias matching domain name
+        exactly, or by a wildcard alias one level up."""
+        index = self.load_distributions()
+        domain_name = domain_name.lower().rstrip('.')
+        dist = index.get(domain_name)
+        if dist is None and '.' in domain_name:
+            dist = index.get('*.' + domain_name.split('.', 1)[1])
+        return dist
 
     def get_cloud_front_arn(self, domain_name):
-        return self.get_matching_distributions(domain_name)['ARN']
+        dist = self.get_matching_distributions(domain_name)
+        return dist['ARN'] if dist else None
 
     def get_cloud_front_tags(self, domain_name):
         cf_arn = self.get_cloud_front_arn(domain_name)
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Pre-compresses text assets so they are stored and served compressed."""
+
+import gzip
+import os
+import tempfile
+from hashlib import sha1
+from websync import utils
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+)
+
+DEFAULT_LEVELS = {'gzip': 9, 'br': 11}
+
+READ_SIZE = 1024 * 1024
+
+
+class Compressor:
+    """Writes compressed copies of files to a staging directory.
+
+    Output is deterministic: gzip headers carry no timestamp or file name,
+    so an unchanged file always compresses to the same bytes and ETag.
+    Staged copies are named after the source's path, size, mtime, inode and
+    ctime, so a source rewritten with its old mtime (cp -p, rsync -t,
+    SOURCE_DATE_EPOCH builds) gets a new copy, and the ETag cache, which is
+    keyed by path, does not mistake it for the old one.  zlib and brotli release the GIL while compressing, so
+    upload worker threads compress in parallel.
+    """
+
+    def __init__(self, encoding='gzip', level=None, types=DEFAULT_TYPES,
+                 staging_dir=None):
+        if encoding not in DEFAULT_LEVELS:
+            raise ValueError(f'Unsupported encoding: {encoding}')
+        if encoding == 'br' and brotli is None:
+            raise ImportError('br encoding requires brotli: pip install brotli')
+        self.encoding = encoding
+        self.level = DEFAULT_LEVELS[encoding] if level is None else level
+        self.types = set(types)
+        self.staging_dir = staging_dir or os.path.join(
+            utils.get_cache_dir(), 'compressed', f'{encoding}-{self.level}')
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def should_compress(self, content_type):
+        return content_type in self.types
+
+    def get_staged_path(self, path, src):
+        """Returns path of the compressed copy of path as it is in the
+        os.stat result src."""
+        name = sha1(os.path.abspath(path).encode('utf-8', 'surrogateescape'))
+        return os.path.join(
+            self.staging_dir,
+            f'{name.hexdigest()}-{src.st_size}-{src.st_mtime_ns}'
+            f'-{src.st_ino}-{src.st_ctime_ns}')
+
+    def compress(self, path):
+        """Returns path of the compressed copy of path, writing it unless
+        it is already staged for the file as it is now.  An older copy of
+        the same file is removed."""
+        src = os.stat(path)
+        staged = self.get_staged_path(path, src)
+        if os.path.exists(staged):
+            return staged
+
+        fd, tmp = tempfile.mkstemp(dir=self.staging_dir)
+        try:
+            with open(path, 'rb') as f_in, os.fdopen(fd, 'wb') as f_out:
+                if self.encoding == 'gzip':
+                    self._gzip(f_in, f_out)
+                else:
+                    self._brotli(f_in, f_out)
+            os.utime(tmp, ns=(src.st_atime_ns, src.st_mtime_ns))
+            os.replace(tmp, staged)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._replace_link(staged)
+        return staged
+
+    def _replace_link(self, staged):
+        """Points the link file of staged's source at staged and removes
+        the copy it pointed at before."""
+        link = os.path.join(
+            self.staging_dir,
+            os.path.basename(staged).split('-', 1)[0] + '.link')
+        try:
+            with open(link) as f:
+                previous = os.path.join(self.staging_dir, f.read())
+        except FileNotFoundError:
+            previous = None
+        fd, tmp = tempfile.mkstemp(dir=self.staging_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.path.basename(staged))
+        os.replace(tmp, link)
+        if previous not in (None, staged):
+            try:
+                os.remove(previous)
+            except FileNotFoundError:
+                pass
+
+    def _gzip(self, f_in, f_out):
+        with gzip.GzipFile(filename='', mode='wb', fileobj=f_out,
+                           compresslevel=self.level, mtime=0) as gz:
+            for data in iter(lambda: f_in.read(READ_SIZE), b''):
+                gz.write(data)
+
+    def _brotli(self, f_in, f_out):
+        compressor = brotli.Compressor(quality=self.level)
+        for data in iter(lambda: f_in.read(READ_SIZE), b''):
+            f_out.write(compressor.process(data))
+        f_out.write(compressor.finish())
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Settings for AWS clients and s3 transfers.
+
+Each setting is read from, in increasing priority: DEFAULTS, the [websync]
+section of ~/.config/websync/config.ini (or the file named by
+$WEBSYNC_CONFIG), WEBSYNC_<NAME> environment variables and command line
+options.  Cache-Control rules are read from its [cache-control] section.
+"""
+
+import configparser
+import os
+
+DEFAULTS = {
+    'max_pool_connections': 10,
+    'retries_mode': 'standard',
+    'max_attempts': 5,
+    'multipart_threshold': 8388608,
+    'multipart_chunksize': 8388608,
+    'max_concurrency': 10,
+    'use_threads': True,
+    'lookup_cache_ttl': 0,
+}
+
+SIZE_SUFFIXES = {
+    'KB': 1024,
+    'MB': 1024 ** 2,
+    'GB': 1024 ** 3,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+}
+
+
+def parse_size(value):
+    """Returns bytes for sizes like 8388608, '8MB' or '16M'."""
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().upper()
+    for suffix, factor in SIZE_SUFFIXES.items():
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+PARSERS = {
+    'max_pool_connections': int,
+    'retries_mode': str,
+    'max_attempts': int,
+    'multipart_threshold': parse_size,
+    'multipart_chunksize': parse_size,
+    'max_concurrency': int,
+    'use_threads': parse_bool,
+    'lookup_cache_ttl': int,
+}
+
+
+def get_config_path():
+    return os.environ.get('WEBSYNC_CONFIG') or os.path.join(
+        os.path.expanduser('~'), '.config', 'websync', 'config.ini')
+
+
+def load_settings(path=None, **overrides):
+    """Returns settings dict merged from all sources.
+    overrides set to None are ignored, so unset CLI options can be passed
+    straight through."""
+    settings = dict(DEFAULTS)
+    parser = configparser.ConfigParser()
+    parser.read(path or get_config_path())
+    if parser.has_section('websync'):
+        for name, value in parser.items('websync'):
+            if name in PARSERS:
+                settings[name] = value
+    for name in PARSERS:
+        value = os.environ.get('WEBSYNC_' + name.upper())
+        if value is not None:
+            settings[name] = value
+    for name, value in overrides.items():
+        if value is not None:
+            settings[name] = value
+    for name, parse in PARSERS.items():
+        settings[name] = parse(settings[name])
+    return settings
+
+
+def load_cache_rules(path=None):
+    """Returns (pattern, Cache-Control) rules from the [cache-control]
+    section of the settings file, in file order."""
+    parser = configparser.ConfigParser(delimiters=('=',), interpolation=None)
+    parser.optionxform = str
+    parser.read(path or get_config_path())
+    if not parser.has_section('cache-control'):
+        return []
+    return list(parser.items('cache-control'))
+
+
+def fit_pool(settings, jobs):
+    """Raises max_pool_connections so `jobs` concurrent uploads, each with
+    up to max_concurrency parts in flight, reuse pooled connections rather
+    than opening new ones.  Call before the client config is built."""
+    settings['max_pool_connections'] = max(
+        settings['max_pool_connections'], jobs + settings['max_concurrency'])
+
+
+def get_client_config(settings):
+    """Returns botocore Config for clients created from settings."""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=settings['max_pool_connections'],
+        retries={
+            'mode': settings['retries_mode'],
+            'max_attempts': settings['max_attempts']
+        }
+    )
+
+
+def get_transfer_config(settings):
+    """Returns s3 TransferConfig for uploads made with settings."""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=settings['multipart_threshold'],
+        multipart_chunksize=settings['multipart_chunksize'],
+        max_concurrency=settings['max_concurrency'],
+        use_threads=settings['use_threads']
+    )
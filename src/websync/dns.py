@@ -1,17 +1,49 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from websync import utils
+from websync.metrics import Metrics
 
 """Classes for AWS Route 53 DNS."""
 
 
 class DNS_Manager:
     """Methods to manage Route53 DNS."""
-    def __init__(self, session):
-        self.client = session.client('route53')
+
+    # Second level labels country code TLDs register domains under, e.g. co.uk.
+    SECOND_LEVEL_LABELS = {
+        'ac', 'co', 'com', 'edu', 'gob', 'gov', 'go', 'ltd', 'ne', 'net',
+        'or', 'org', 'plc',
+    }
+
+    CLOUDFRONT_ZONE_ID = 'Z2FDTNDATAQYW2'
+    # A change batch holds at most 1000 records and an UPSERT counts twice.
+    MAX_BATCH_UPSERTS = 500
+
+    def __init__(self, session, config=None, cache_ttl=0, metrics=None):
+        self.client = session.client('route53', config=config)
+        self.metrics = metrics or Metrics()
+        self.metrics.instrument(self.client)
         self.session = session
+        self.cache_ttl = cache_ttl
+        self.zones = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def alias_record(domain_name, target_zone_id, target_dns_name):
+        """Returns an A alias ResourceRecordSet."""
+        return {
+            'Name': domain_name,
+            'Type': 'A',
+            'AliasTarget': {
+                'HostedZoneId': target_zone_id,
+                'DNSName': target_dns_name,
+                'EvaluateTargetHealth': False
+            }
+        }
 
     def create_cf_dns_record(self, zone, domain_name, cf_dist):
         """Creates DNS record for CloudFront Distribution."""
@@ -22,27 +54,36 @@ class DNS_Manager:
                 'Changes': [
                     {
                         'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': 'Z2FDTNDATAQYW2',
-                                'DNSName': cf_dist,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
+                        'ResourceRecordSet': self.alias_record(
+                            domain_name, self.CLOUDFRONT_ZONE_ID, cf_dist)
                     }
                 ]
             }
         )
 
-    def create_hosted_zone(self, domain_name):
-        """Creates a hosted zone in Route53 DNS"""
-        zone_name = ".".join(domain_name.split('.')[-2:]) + "."
-        return self.client.create_hosted_zone(
-            Name=zone_name,
+    @classmethod
+    def get_apex_domain(cls, domain_name):
+        """Returns the registered domain for domain name, e.g. example.com
+        for www.example.com and example.co.uk for www.example.co.uk."""
+        labels = domain_name.lower().rstrip('.').split('.')
+        if len(labels) >= 3 and len(labels[-1]) == 2 \
+                and labels[-2] in cls.SECOND_LEVEL_LABELS:
+            return '.'.join(labels[-3:])
+        return '.'.join(labels[-2:])
+
+    def create_hosted_zone(self, domain_name, zone_name=None):
+        """Creates a hosted zone in Route53 DNS for zone name, or the apex
+        domain of domain name."""
+        zone_name = (zone_name or self.get_apex_domain(domain_name)).rstrip('.')
+        zone = self.client.create_hosted_zone(
+            Name=zone_name + '.',
             CallerReference=str(uuid.uuid4())
-        )
+        )['HostedZone']
+        index = self.load_hosted_zones()
+        with self.lock:
+            index[zone_name.lower()] = zone
+            utils.remove_json_cache(self.get_cache_name())
+        return zone
 
     def create_s3_dns_record(self, zone, domain_name, endpoint):
         """Creates DNS record for static website hosted in S3 Bucket."""
@@ -53,24 +94,131 @@ class DNS_Manager:
                 'Changes': [
                     {
                         'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': endpoint.dnszone,
-                                'DNSName': endpoint.site,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
+                        'ResourceRecordSet': self.alias_record(
+                            domain_name, endpoint.dnszone, endpoint.site)
                     }
                 ]
             }
         )
 
+    def get_cache_name(self):
+        return f'hosted-zones-{self.session.profile_name or "default"}.json'
+
+    def load_hosted_zones(self, refresh=False):
+        """Returns index of lower cased zone name -> hosted zone.
+        Public zones win over private zones of the same name.  Zones are
+        listed once per run, or read from the on-disk cache while it is
+        younger than cache_ttl seconds."""
+        with self.lock:
+            if self.zones is not None and not refresh:
+                return self.zones
+            if not refresh:
+                cached = utils.read_json_cache(
+                    self.get_cache_name(), self.cache_ttl)
+                if cached is not None:
+                    self.zones = cached
+                    return cached
+
+            index = {}
+            paginator = self.client.get_paginator('list_hosted_zones')
+            with self.metrics.timer('list_hosted_zones'):
+                for page in paginator.paginate():
+                    for zone in page['HostedZones']:
+                        name = zone['Name'].rstrip('.').lower()
+                        private = zone.get('Config', {}).get('PrivateZone', False)
+                        if private and name in index:
+                            continue
+                        index[name] = zone
+            self.zones = index
+            if self.cache_ttl:
+                utils.write_json_cache(self.get_cache_name(), index)
+            return index
+
     def get_hosted_zone(self, domain_name):
-        paginator = self.client.get_paginator('list_hosted_zones')
-        for page in paginator.paginate():
-            for zone in page['HostedZones']:
-                if domain_name.endswith(zone['Name'][:-1]):
-                    return zone
-            return None
+        """Returns the most specific hosted zone containing domain name."""
+        index = self.load_hosted_zones()
+        labels = domain_name.lower().rstrip('.').split('.')
+        for i in range(len(labels)):
+            zone = index.get('.'.join(labels[i:]))
+            if zone is not None:
+                return zone
+        return None
+
+
+    def get_alias_records(self, zone_id):
+        """Returns lower cased name -> (zone id, dns name) for the A alias
+        records in hosted zone."""
+        records = {}
+        paginator = self.client.get_paginator('list_resource_record_sets')
+        for page in paginator.paginate(HostedZoneId=zone_id):
+            for record in page['ResourceRecordSets']:
+                alias = record.get('AliasTarget')
+                if record['Type'] != 'A' or not alias:
+                    continue
+                records[record['Name'].rstrip('.').lower()] = (
+                    alias['HostedZoneId'],
+                    alias['DNSName'].rstrip('.').lower()
+                )
+        return records
+
+    def sync_alias_records(self, targets, wait=False, jobs=8):
+        """Points A alias records at their targets in as few change batches
+        as possible.
+
+        targets is an iterable of (domain name, target zone id, target dns
+        name).  Records are grouped by hosted zone and records that already
+        point at their target are skipped.  With wait, blocks until all
+        changes are INSYNC.  Returns (ChangeInfo list, domains with no
+        hosted zone).  A domain listed more than once gets its last target.
+        """
+        # Route 53 rejects a batch that changes the same record twice.
+        unique = {}
+        for target in targets:
+            unique[target[0].rstrip('.').lower()] = target
+        zones = {}
+        missing = []
+        for domain_name, target_zone_id, target_dns_name in unique.values():
+            zone = self.get_hosted_zone(domain_name)
+            if zone is None:
+                print(f'No hosted zone found for {domain_name}.')
+                missing.append(domain_name)
+                continue
+            zones.setdefault(zone['Id'], []).append(
+                (domain_name, target_zone_id, target_dns_name))
+
+        changes = []
+        for zone_id, records in zones.items():
+            existing = self.get_alias_records(zone_id)
+            pending = [
+                record for record in records
+                if existing.get(record[0].rstrip('.').lower())
+                != (record[1], record[2].rstrip('.').lower())
+            ]
+            print(f'{zone_id}: {len(pending)} record(s) to change, '
+                  f'{len(records) - len(pending)} already up to date.')
+            for i in range(0, len(pending), self.MAX_BATCH_UPSERTS):
+                response = self.client.change_resource_record_sets(
+                    HostedZoneId=zone_id,
+                    ChangeBatch={
+                        'Comment': 'Created by web-sync',
+                        'Changes': [
+                            {
+                                'Action': 'UPSERT',
+                                'ResourceRecordSet': self.alias_record(*record)
+                            }
+                            for record in pending[i:i + self.MAX_BATCH_UPSERTS]
+                        ]
+                    }
+                )
+                changes.append(response['ChangeInfo'])
+                self.metrics.incr('dns_records_changed', len(
+                    pending[i:i + self.MAX_BATCH_UPSERTS]))
+
+        if wait and changes:
+            print(f'Waiting for {len(changes)} change batch(es) to sync...')
+            waiter = self.client.get_waiter('resource_record_sets_changed')
+            with self.metrics.timer('dns_wait'), \
+                    ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(
+                    lambda change: waiter.wait(Id=change['Id']), changes))
+        return changes, missing
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of local file ETags."""
+
+import os
+import sqlite3
+import threading
+from websync import utils
+
+
+class EtagCache:
+    """Stores file ETags keyed by path, size, mtime and multipart settings.
+
+    A file whose size and mtime have not changed since it was last hashed
+    is not opened again.  Entries computed with a different chunk size or
+    multipart threshold are ignored, since the multipart ETag depends on
+    them.
+
+    It also remembers a digest of the headers last applied to each object,
+    so unchanged objects need no HEAD request to check them.
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path=None, rehash=False):
+        self.path = path or os.path.join(utils.get_cache_dir(), 'etags.db')
+        self.rehash = rehash
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS etags')
+            self.db.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS etags ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER,'
+            ' mtime_ns INTEGER,'
+            ' chunk_size INTEGER,'
+            ' threshold INTEGER,'
+            ' etag TEXT)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS headers ('
+            ' bucket TEXT,'
+            ' key TEXT,'
+            ' etag TEXT,'
+            ' digest TEXT,'
+            ' PRIMARY KEY (bucket, key))'
+        )
+
+    def get(self, filepath, chunk_size, threshold):
+        """Returns cached ETag for filepath or None if stale or missing."""
+        if self.rehash:
+            return None
+        st = os.stat(filepath)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag FROM etags WHERE path = ? AND size = ?'
+                ' AND mtime_ns = ? AND chunk_size = ? AND threshold = ?',
+                (str(filepath), st.st_size, st.st_mtime_ns, chunk_size,
+                 threshold)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, filepath, chunk_size, threshold, etag, stat=None):
+        """Records ETag for filepath as of its current size and mtime."""
+        st = stat or os.stat(filepath)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO etags VALUES (?, ?, ?, ?, ?, ?)',
+                (str(filepath), st.st_size, st.st_mtime_ns, chunk_size,
+                 threshold, etag)
+            )
+
+    def get_headers(self, bucket, key, etag):
+        """Returns digest of the headers applied to key while it had etag,
+        or None if unknown."""
+        if self.rehash:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                'SELECT digest FROM headers'
+                ' WHERE bucket = ? AND key = ? AND etag = ?',
+                (bucket, key, etag)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_headers(self, bucket, key, etag, digest):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                (bucket, key, etag, digest)
+            )
+
+    def save(self):
+        """Writes pending entries to disk."""
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.save()
+        self.db.close()
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Deploys many websites at once from a YAML manifest.
+
+    defaults:
+      cloudfront: true
+      tags:
+        Team: web
+    sites:
+      - domain: www.example.com
+        path: sites/www
+      - domain: blog.example.com
+        path: sites/blog
+        cloudfront: false
+
+Relative paths are resolved from the manifest's directory.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import threading
+import time
+from websync import utils
+from websync.dns import DNS_Manager
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+SITE_DEFAULTS = {
+    'path': None,
+    'bucket': None,
+    'setup_bucket': False,
+    'cloudfront': False,
+    'invalidate': False,
+    'dns': True,
+    'zone': None,
+    'tags': {},
+}
+
+
+def load_manifest(path):
+    """Returns list of site dicts from the manifest at path, each with
+    every key of SITE_DEFAULTS plus its domain."""
+    if yaml is None:
+        raise ImportError('deploy-fleet requires PyYAML: pip install pyyaml')
+    with open(path) as f:
+        manifest = yaml.safe_load(f) or {}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('sites'), list):
+        raise ValueError('manifest must have a "sites" list')
+
+    defaults = dict(SITE_DEFAULTS)
+    defaults.update(manifest.get('defaults') or {})
+    base = os.path.dirname(os.path.abspath(path))
+    sites = []
+    domains, buckets = set(), set()
+    for number, entry in enumerate(manifest['sites'], 1):
+        if not isinstance(entry, dict) or not entry.get('domain'):
+            raise ValueError(f'site {number}: domain is required')
+        site = dict(defaults)
+        site.update(entry)
+        unknown = set(site) - set(SITE_DEFAULTS) - {'domain'}
+        if unknown:
+            raise ValueError(
+                f'site {number}: unknown key(s) {", ".join(sorted(unknown))}')
+        if not site['path']:
+            raise ValueError(f'site {number}: path is required')
+        site['path'] = os.path.join(base, os.path.expanduser(site['path']))
+        if not os.path.isdir(site['path']):
+            raise ValueError(f'site {number}: {site["path"]} is not a directory')
+        if site['invalidate'] and not site['cloudfront']:
+            raise ValueError(f'site {number}: invalidate requires cloudfront')
+        site['bucket'] = site['bucket'] or site['domain']
+        if site['domain'] in domains or site['bucket'] in buckets:
+            raise ValueError(f'site {number}: domain or bucket is used twice')
+        domains.add(site['domain'])
+        buckets.add(site['bucket'])
+        sites.append(site)
+    return sites
+
+
+class SiteReport:
+    """Outcome of deploying one site."""
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.result = None
+        self.dns_target = None
+        self.error = None
+        self.seconds = 0.0
+
+    @property
+    def status(self):
+        if self.error:
+            return 'error'
+        if self.result is None or self.result.failed:
+            return 'failed'
+        return 'ok'
+
+
+class FleetDeployer:
+    """Deploys sites concurrently through one Manager.
+
+    Sites share the Manager's clients, connection pools, ETag cache and
+    lookup indexes.  The jobs budget is split between the sites deployed
+    at once, so the fleet never runs more than jobs uploads together.
+    DNS records for every site are written in one batch per hosted zone
+    after the sites are synced.
+    """
+
+    def __init__(self, manager, jobs=8, parallel=4):
+        self.manager = manager
+        self.jobs = jobs
+        self.parallel = max(1, min(parallel, jobs))
+        self.site_jobs = max(1, jobs // self.parallel)
+        self.zone_lock = threading.Lock()
+
+    def prewarm(self, sites):
+        """Loads the lookup indexes sites need in parallel, so site workers
+        start from warm shared caches instead of racing to list them."""
+        loaders = []
+        if any(site['cloudfront'] for site in sites):
+            loaders += [
+                self.manager.cloudfront_manager.load_distributions,
+                self.manager.cloudfront_manager.load_origin_access_identities,
+                self.manager.certificate_manager.load_certificates,
+            ]
+        if any(site['dns'] for site in sites):
+            loaders.append(self.manager.dns_manager.load_hosted_zones)
+        if not loaders:
+            return
+        with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+            for future in [executor.submit(loader) for loader in loaders]:
+                future.result()
+
+    def get_zone(self, site):
+        """Returns hosted zone for site, creating it if none contains it."""
+        dns_manager = self.manager.dns_manager
+        with self.zone_lock:
+            return dns_manager.get_hosted_zone(site['domain']) \
+                or dns_manager.create_hosted_zone(site['domain'], site['zone'])
+
+    def deploy_site(self, site):
+        """Syncs, tags and configures one site.  Returns its SiteReport."""
+        domain, bucket = site['domain'], site['bucket']
+        bucket_manager = self.manager.bucket_manager
+        cloudfront_manager = self.manager.cloudfront_manager
+        report = SiteReport(domain)
+        start = time.perf_counter()
+        print(f'[{domain}] Syncing {site["path"]} to {bucket} '
+              f'with {self.site_jobs} job(s).')
+        # One broken site must not stop the rest of the fleet, so any
+        # error is recorded in its report instead of raised.
+        try:
+            if site['setup_bucket']:
+                self.manager.setup_bucket(bucket)
+            report.result = bucket_manager.sync_bucket(
+                site['path'], bucket, self.site_jobs)
+            for key, value in site['tags'].items():
+                bucket_manager.set_bucket_tag(bucket, key, str(value))
+
+            if site['cloudfront']:
+                cf_dist = self.manager.setup_distribution(domain, bucket)
+                if not cf_dist:
+                    raise LookupError(f'no certificate matches {domain}')
+                for key, value in site['tags'].items():
+                    cloudfront_manager.set_cloud_front_tag(
+                        domain, key, str(value), arn=cf_dist['ARN'])
+                if site['invalidate'] and report.result.changed:
+                    cloudfront_manager.invalidate_paths(
+                        domain, report.result.changed)
+                target = (domain, DNS_Manager.CLOUDFRONT_ZONE_ID,
+                          cf_dist['DomainName'])
+            else:
+                endpoint = utils.get_endpoint(
+                    bucket_manager.get_bucket_region(bucket))
+                target = (domain, endpoint.dnszone, endpoint.site)
+
+            if site['dns']:
+                self.get_zone(site)
+                report.dns_target = target
+        except Exception as e:
+            report.error = f'{type(e).__name__}: {e}'
+            print(f'[{domain}] {report.error}')
+        report.seconds = time.perf_counter() - start
+        return report
+
+    def deploy(self, sites, wait=False):
+        """Deploys sites and their DNS records.  Returns SiteReports in
+        manifest order."""
+        self.prewarm(sites)
+        reports = [None] * len(sites)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = {
+                executor.submit(self.deploy_site, site): i
+                for i, site in enumerate(sites)
+            }
+            for future in as_completed(futures):
+                report = reports[futures[future]] = future.result()
+                done += 1
+                print(f'[{report.domain}] {report.status} in '
+                      f'{report.seconds:.1f}s ({done}/{len(sites)} sites done).')
+
+        targets = [r.dns_target for r in reports if r.dns_target]
+        if targets:
+            _, missing = self.manager.dns_manager.sync_alias_records(
+                targets, wait, self.jobs)
+            for report in reports:
+                if report.domain in missing:
+                    report.error = 'no hosted zone'
+        return reports
+
+    @staticmethod
+    def format_summary(reports):
+        """Returns a text table of reports."""
+        header = ('SITE', 'STATUS', 'UPLOADED', 'DELETED', 'SKIPPED',
+                  'FAILED', 'SECONDS')
+        rows = [header]
+        for report in reports:
+            result = report.result
+            counts = [
+                len(result.uploaded), len(result.deleted),
+                result.skipped, len(result.failed)
+            ] if result else ['-'] * 4
+            rows.append((report.domain, report.status, *counts,
+                         f'{report.seconds:.1f}'))
+        widths = [max(len(str(row[i])) for row in rows)
+                  for i in range(len(header))]
+        lines = []
+        for row in rows:
+            cells = [str(row[0]).ljust(widths[0]), str(row[1]).ljust(widths[1])]
+            cells += [str(v).rjust(w) for v, w in zip(row[2:], widths[2:])]
+            lines.append('  '.join(cells))
+        return '\n'.join(lines)
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Functions to compute S3 ETags for local files."""
+
+import math
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+
+# Limits s3transfer applies when splitting an upload into parts.
+MIN_PART_SIZE = 5 * 1024 ** 2
+MAX_PARTS = 10000
+
+_executor = None
+
+
+def get_executor():
+    """Returns a shared thread pool for hashing file parts.
+    md5 releases the GIL for large buffers so parts hash in parallel."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _executor
+
+
+def _part_digest(buf, start, end):
+    view = buf[start:end]
+    try:
+        return md5(view).digest()
+    finally:
+        view.release()
+
+
+def part_size(size, chunk_size):
+    """Returns the part size s3transfer uses to upload size bytes."""
+    chunk_size = max(chunk_size, MIN_PART_SIZE)
+    while math.ceil(size / chunk_size) > MAX_PARTS:
+        chunk_size *= 2
+    return chunk_size
+
+
+def file_etag(filepath, chunk_size, threshold=None, parallel=True):
+    """Returns the ETag s3 gives filepath when uploaded with a TransferConfig
+    using multipart_chunksize=chunk_size and multipart_threshold=threshold.
+    threshold defaults to chunk_size."""
+    size = os.path.getsize(filepath)
+    if threshold is None:
+        threshold = chunk_size
+    if size == 0:
+        return '"{}"'.format(md5().hexdigest())
+    chunk_size = part_size(size, chunk_size)
+
+    with open(filepath, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        buf = memoryview(mm)
+        try:
+            if size < threshold:
+                return '"{}"'.format(md5(buf).hexdigest())
+            offsets = range(0, size, chunk_size)
+            if parallel:
+                digests = list(get_executor().map(
+                    lambda start: _part_digest(buf, start, start + chunk_size),
+                    offsets
+                ))
+            else:
+                digests = [
+                    _part_digest(buf, start, start + chunk_size)
+                    for start in offsets
+                ]
+        finally:
+            buf.release()
+
+    return '"{}-{}"'.format(md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def cached_file_etag(filepath, chunk_size, threshold, etag_cache=None):
+    """Returns ETag for filepath, looking it up in etag_cache first."""
+    if etag_cache is None:
+        return file_etag(filepath, chunk_size, threshold)
+    etag = etag_cache.get(filepath, chunk_size, threshold)
+    if etag is None:
+        # Stat before reading so a file modified while hashing is
+        # hashed again next time.
+        stat = os.stat(filepath)
+        etag = file_etag(filepath, chunk_size, threshold)
+        etag_cache.set(filepath, chunk_size, threshold, etag, stat)
+    return etag
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Journal of in-progress multipart uploads, so interrupted syncs resume."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from websync import utils
+
+
+class UploadJournal:
+    """Records multipart upload IDs and their completed parts per key.
+
+    An upload is started with the file's size, mtime, part size and
+    headers; it is only resumed while all of them still match.  Every
+    write is committed at once so the journal survives the process being
+    killed.  Only uploads recorded here are ever aborted, never ones
+    started by other tools.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(utils.get_cache_dir(), 'uploads.db')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS uploads')
+            self.db.execute('DROP TABLE IF EXISTS parts')
+            self.db.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            ' bucket TEXT,'
+            ' key TEXT,'
+            ' upload_id TEXT,'
+            ' path TEXT,'
+            ' size INTEGER,'
+            ' mtime_ns INTEGER,'
+            ' part_size INTEGER,'
+            ' extra_args TEXT,'
+            ' started REAL,'
+            ' PRIMARY KEY (bucket, key))'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS parts ('
+            ' upload_id TEXT,'
+            ' part_number INTEGER,'
+            ' etag TEXT,'
+            ' PRIMARY KEY (upload_id, part_number))'
+        )
+        self.db.commit()
+
+    @staticmethod
+    def _row(row):
+        keys = ('bucket', 'key', 'upload_id', 'path', 'size', 'mtime_ns',
+                'part_size', 'extra_args', 'started')
+        entry = dict(zip(keys, row))
+        entry['extra_args'] = json.loads(entry['extra_args'])
+        return entry
+
+    def get(self, bucket, key):
+        """Returns the upload recorded for key as a dict, or None."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT * FROM uploads WHERE bucket = ? AND key = ?',
+                (bucket, key)
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def matches(self, entry, path, part_size, extra_args):
+        """Returns True if entry was started for path as it is now."""
+        st = os.stat(path)
+        return (entry['path'] == str(path)
+                and entry['size'] == st.st_size
+                and entry['mtime_ns'] == st.st_mtime_ns
+                and entry['part_size'] == part_size
+                and entry['extra_args'] == extra_args)
+
+    def start(self, bucket, key, upload_id, path, part_size, extra_args):
+        """Records a new upload of path, replacing any earlier one."""
+        st = os.stat(path)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (bucket, key, upload_id, str(path), st.st_size,
+                 st.st_mtime_ns, part_size,
+                 json.dumps(extra_args, sort_keys=True), time.time())
+            )
+            self.db.commit()
+
+    def add_part(self, upload_id, part_number, etag):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO parts VALUES (?, ?, ?)',
+                (upload_id, part_number, etag)
+            )
+            self.db.commit()
+
+    def get_parts(self, upload_id):
+        """Returns {part number: ETag} of parts recorded for upload_id."""
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT part_number, etag FROM parts WHERE upload_id = ?',
+                (upload_id,)
+            ))
+
+    def remove(self, bucket, key):
+        """Forgets the upload of key once it is completed or aborted."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT upload_id FROM uploads WHERE bucket = ? AND key = ?',
+                (bucket, key)
+            ).fetchone()
+            if row:
+                self.db.execute('DELETE FROM parts WHERE upload_id = ?', row)
+                self.db.execute(
+                    'DELETE FROM uploads WHERE bucket = ? AND key = ?',
+                    (bucket, key))
+                self.db.commit()
+
+    def uploads(self, bucket):
+        """Returns all uploads recorded for bucket."""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT * FROM uploads WHERE bucket = ?', (bucket,)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
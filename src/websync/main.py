@@ -13,33 +13,217 @@
 - Configures AWS CloudFront CDN
 """
 
-from pathlib import Path
+import json
+import threading
 import click
-import boto3
-from botocore.exceptions import ClientError
-from websync.dns import DNS_Manager
-from websync.cert import CertificateManager
-from websync.cloudfront import CloudFrontManager
-from websync.s3bucket import BucketManager
+from websync.cachecontrol import CachePolicy
+from websync.metrics import Metrics
 from websync.session import SessionConfig
-from websync import utils
+from websync import config, utils
 
+# boto3 and the manager modules are imported where they are first used so
+# that --help and commands needing one AWS client start quickly.
 
 
 class Manager(object):
-    def __init__(self, boto_session):
-        self.bucket_manager = BucketManager(boto_session) 
-        self.dns_manager = DNS_Manager(boto_session)
-        self.certificate_manager = CertificateManager(boto_session)
-        self.cloudfront_manager = CloudFrontManager(boto_session)
+    """Creates each AWS manager, and its boto3 client, on first use."""
+    def __init__(self, session_config, profile=None, endpoint_url=None,
+                 config_path=None):
+        self.session_config = session_config
+        self.profile = profile
+        self.config_path = config_path
+        self.endpoint_url = endpoint_url
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self._bucket_manager = None
+        self._dns_manager = None
+        self._certificate_manager = None
+        self._cloudfront_manager = None
+
+    @property
+    def transfer_config(self):
+        return self.session_config.transfer_config
+
+    @property
+    def bucket_manager(self):
+        with self.lock:
+            if self._bucket_manager is None:
+                from websync.s3bucket import BucketManager
+                self._bucket_manager = BucketManager(
+                    self.session_config.session,
+                    endpoint_url=self.endpoint_url,
+                    config=self.session_config.client_config,
+                    transfer_config=self.transfer_config,
+                    metrics=self.metrics
+                )
+            return self._bucket_manager
+
+    @property
+    def dns_manager(self):
+        with self.lock:
+            if self._dns_manager is None:
+                from websync.dns import DNS_Manager
+                self._dns_manager = DNS_Manager(
+                    self.session_config.session,
+                    self.session_config.client_config,
+                    cache_ttl=self.session_config.settings['lookup_cache_ttl'],
+                    metrics=self.metrics
+                )
+            return self._dns_manager
+
+    @property
+    def certificate_manager(self):
+        with self.lock:
+            if self._certificate_manager is None:
+                from websync.cert import CertificateManager
+                self._certificate_manager = CertificateManager(
+                    self.session_config.session,
+                    self.session_config.client_config,
+                    cache_ttl=self.session_config.settings['lookup_cache_ttl'],
+                    metrics=self.metrics
+                )
+            return self._certificate_manager
+
+    @property
+    def cloudfront_manager(self):
+        with self.lock:
+            if self._cloudfront_manager is None:
+                from websync.cloudfront import CloudFrontManager
+                self._cloudfront_manager = CloudFrontManager(
+                    self.session_config.session,
+                    self.session_config.client_config,
+                    cache_ttl=self.session_config.settings['lookup_cache_ttl'],
+                    metrics=self.metrics
+                )
+            return self._cloudfront_manager
+
+    def setup_bucket(self, bucket):
+        """Creates and configures an s3 bucket for website hosting."""
+        self.bucket_manager.create_bucket(bucket)
+        self.bucket_manager.set_bucket_versioning(bucket)
+        self.bucket_manager.set_bucket_tag(bucket)
+        self.bucket_manager.set_bucket_policy(bucket)
+        self.bucket_manager.set_bucket_website(bucket)
+
+    def setup_distribution(self, domain, bucket):
+        """Returns the CloudFront distribution for domain, creating it if
+        needed, and lets its Origin Access ID read bucket.
+        Returns None if no certificate matches domain."""
+        cf_dist = self.cloudfront_manager.get_matching_distributions(domain)
+        if not cf_dist:
+            certificate = self.certificate_manager.get_matching_certificates(domain)
+            if not certificate:
+                print(f'No matching certificate found for {domain}.')
+                return None
+            cf_dist = self.cloudfront_manager.create_distribution_with_tags(domain, certificate)
+            print(f'Waiting for distribution deployment for {domain}...')
+            print("It can take ~30 minutes for CloudFront to fully deploy the distribution ")
+            self.cloudfront_manager.awaiting_deployment(cf_dist)
+
+        print('Setting Bucket Policy for CloudFront Origin Access ID.')
+        origin_access_id = self.cloudfront_manager.get_origin_access_identity(domain)
+        self.bucket_manager.set_cloud_front_bucket_policy(bucket, origin_access_id)
+        return cf_dist
+
 
 @click.group()
 @click.option('--profile', default=None, help='Selects an AWS profile.')
+@click.option('--endpoint-url', default=None,
+              help='S3 endpoint to use instead of AWS, e.g. a moto server.')
+@click.option('--config', 'config_path', default=None,
+              type=click.Path(dir_okay=False),
+              help='Settings file [default: ~/.config/websync/config.ini].')
+@click.option('--max-pool-connections', type=int, default=None,
+              help='HTTP connections kept per AWS client.')
+@click.option('--retries-mode', default=None,
+              type=click.Choice(['legacy', 'standard', 'adaptive']),
+              help='botocore retry mode.')
+@click.option('--max-attempts', type=int, default=None,
+              help='Attempts per AWS request, including the first.')
+@click.option('--multipart-threshold', default=None,
+              help='Size at which uploads switch to multipart, e.g. 8MB.')
+@click.option('--multipart-chunksize', default=None,
+              help='Multipart upload part size, e.g. 8MB.')
+@click.option('--max-concurrency', type=int, default=None,
+              help='Threads used for the parts of one upload.')
+@click.option('--use-threads/--no-use-threads', default=None,
+              help='Upload parts of one file in threads.')
+@click.option('--lookup-cache-ttl', type=int, default=None,
+              help='Seconds to reuse cached AWS lookups such as the '
+                   'CloudFront alias, certificate and hosted zone indexes '
+                   'between runs '
+                   '[default: 0].')
+@click.option('--profile-out', default=None, type=click.Path(dir_okay=False),
+              help='Write phase timers, counters and AWS call latency of '
+                   'the run to this file: a Prometheus textfile if it ends '
+                   'in .prom, otherwise appended JSON lines.')
 @click.pass_context
-def cli(ctx, profile):
-    """Web Sync deploys websites to AWS."""
-    boto_session = SessionConfig(profile).session
-    ctx.obj = Manager(boto_session)
+def cli(ctx, profile, endpoint_url, config_path, profile_out, **settings):
+    """Web Sync deploys websites to AWS.
+
+    Transfer and connection settings can also be set in the [websync]
+    section of the config file or with WEBSYNC_<SETTING> environment
+    variables, e.g. WEBSYNC_MAX_POOL_CONNECTIONS=50.
+    """
+    session_config = SessionConfig(
+        profile, config.load_settings(config_path, **settings))
+    ctx.obj = Manager(session_config, profile, endpoint_url, config_path)
+    if profile_out:
+        # Closing the context exits the command timer, then writes.
+        ctx.call_on_close(lambda: ctx.obj.metrics.write(
+            profile_out, command=ctx.invoked_subcommand))
+        ctx.with_resource(ctx.obj.metrics.timer('command'))
+
+
+@cli.command('deploy-fleet')
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--jobs', default=32, show_default=True,
+              type=click.IntRange(min=1),
+              help='Uploads running at once across all sites.')
+@click.option('--parallel', default=4, show_default=True,
+              type=click.IntRange(min=1),
+              help='Sites deployed at once; each gets an equal share of --jobs.')
+@click.option('--rehash', is_flag=True,
+              help='Ignore cached ETags and hash every file again.')
+@click.option('--wait', is_flag=True,
+              help='Wait until DNS changes have propagated.')
+@click.pass_obj
+def deploy_fleet(mgr, manifest, jobs, parallel, rehash, wait):
+    """Syncs, tags and configures DNS and CloudFront for every site in a
+    YAML MANIFEST (requires PyYAML).
+
+    \b
+    sites:
+      - domain: www.example.com
+        path: sites/www
+        cloudfront: true
+        tags: {Team: web}
+
+    Sites may also set bucket, setup_bucket, invalidate, dns and zone;
+    a top level defaults mapping applies to every site.
+    """
+    from websync.etagcache import EtagCache
+    from websync.fleet import FleetDeployer, load_manifest
+    from websync.journal import UploadJournal
+    from websync.snapshot import ManifestSnapshots
+    try:
+        sites = load_manifest(manifest)
+    except (ImportError, ValueError) as e:
+        raise click.ClickException(str(e))
+    # Every site shares one s3 client.
+    config.fit_pool(mgr.session_config.settings, jobs)
+    mgr.bucket_manager.etag_cache = EtagCache(rehash=rehash)
+    mgr.bucket_manager.journal = UploadJournal()
+    mgr.bucket_manager.snapshots = ManifestSnapshots()
+    policy = CachePolicy(config.load_cache_rules(mgr.config_path))
+    if policy.rules:
+        mgr.bucket_manager.cache_policy = policy
+    deployer = FleetDeployer(mgr, jobs, parallel)
+    reports = deployer.deploy(sites, wait)
+    print(deployer.format_summary(reports))
+    failed = [r.domain for r in reports if r.status != 'ok']
+    if failed:
+        raise click.ClickException('Not deployed: ' + ', '.join(failed))
 
 
 @cli.command('disable-bucket-versions')
@@ -105,42 +289,30 @@ def list_buckets(mgr):
 @click.pass_obj
 def setup_bucket(mgr, bucket):
     """Creates and configures an s3 bucket."""
-    mgr.bucket_manager.create_bucket(bucket)
-    mgr.bucket_manager.set_bucket_versioning(bucket)
-    mgr.bucket_manager.set_bucket_tag(bucket)
-    mgr.bucket_manager.set_bucket_policy(bucket)
-    mgr.bucket_manager.set_bucket_website(bucket)
+    mgr.setup_bucket(bucket)
 
 
 @cli.command('setup-cloudfront')
 @click.argument('domain')
 @click.argument('bucket')
+@click.option('--zone', default=None,
+              help='Hosted zone to create if none contains the domain '
+                   '[default: the registered domain].')
 @click.pass_obj
-def setup_cloudfront(mgr, domain, bucket):
+def setup_cloudfront(mgr, domain, bucket, zone):
     """Creates a  CloudFront Distribution.
         Checks for SSL Certificate matching domain.
         Checks for matching Origin Access ID and creates one if not found.
         Sets s3 bucket policy to use OA ID.
         Creates DNS A Alias record to point to CloudFront Distribution.
     """
-    cf_dist = mgr.cloudfront_manager.get_matching_distributions(domain)
-    print(cf_dist)
+    cf_dist = mgr.setup_distribution(domain, bucket)
     if not cf_dist:
-        certificate = mgr.certificate_manager.get_matching_certificates(domain)
-        if not certificate:
-            print('No matching certificate found.  Existing Application')
-            return False
-        cf_dist = mgr.cloudfront_manager.create_distribution_with_tags(domain, certificate)
-        print('Waiting for distribution deployment...')
-        print("It can take ~30 minutes for CloudFront to fully deploy the distribution ")
-        mgr.cloudfront_manager.awaiting_deployment(cf_dist)
-
-    print('Setting Bucket Policy for CloudFront Origin Access ID.')
-    origin_access_id = mgr.cloudfront_manager.get_origin_access_identity(domain)
-    mgr.bucket_manager.set_cloud_front_bucket_policy(bucket, origin_access_id)
+        print('Exiting Application')
+        return False
 
     zone = mgr.dns_manager.get_hosted_zone(domain) \
-        or mgr.dns_manager.create_hosted_zone(domain)
+        or mgr.dns_manager.create_hosted_zone(domain, zone)
     mgr.dns_manager.create_cf_dns_record(
         zone,
         domain,
@@ -151,12 +323,15 @@ def setup_cloudfront(mgr, domain, bucket):
 
 @cli.command('setup-dns')
 @click.argument('domain')
+@click.option('--zone', default=None,
+              help='Hosted zone to create if none contains the domain '
+                   '[default: the registered domain].')
 @click.pass_obj
-def setup_dns(mgr, domain):
+def setup_dns(mgr, domain, zone):
     """Creates DNS Alias Record to point to static s3 bucket hosting website"""
     bucket = mgr.bucket_manager.get_bucket_name(domain)
     zone = mgr.dns_manager.get_hosted_zone(domain) \
-        or mgr.dns_manager.create_hosted_zone(domain)
+        or mgr.dns_manager.create_hosted_zone(domain, zone)
     endpoint = utils.get_endpoint(mgr.bucket_manager.get_bucket_region(bucket))
     a_record = mgr.dns_manager.create_s3_dns_record(
         zone,
@@ -165,14 +340,284 @@ def setup_dns(mgr, domain):
     print(f"Domain configured: http://{domain}")
 
 
+@cli.command('setup-dns-bulk')
+@click.argument('mappings', type=click.File())
+@click.option('--wait', is_flag=True,
+              help='Wait until every change has propagated.')
+@click.option('--jobs', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of targets to look up concurrently.')
+@click.pass_obj
+def setup_dns_bulk(mgr, mappings, wait, jobs):
+    """Creates DNS Alias Records for many domains at once.
+
+    MAPPINGS has one domain per line, optionally followed by its target:
+    "s3" (default) for the website bucket of the same name, or "cloudfront"
+    for the distribution with the domain as an alias.  Blank lines and
+    lines starting with # are ignored.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from botocore.exceptions import ClientError
+    from websync.dns import DNS_Manager
+    entries = []
+    seen = {}
+    for number, line in enumerate(mappings, 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        target = fields[1].lower() if len(fields) > 1 else 's3'
+        if target not in ('s3', 'cloudfront') or len(fields) > 2:
+            raise click.BadParameter(
+                f'line {number}: expected "DOMAIN [s3|cloudfront]"',
+                param_hint='MAPPINGS')
+        name = fields[0].rstrip('.').lower()
+        if name in seen:
+            if seen[name] != target:
+                raise click.BadParameter(
+                    f'line {number}: {fields[0]} is already mapped to '
+                    f'{seen[name]}', param_hint='MAPPINGS')
+            continue
+        seen[name] = target
+        entries.append((fields[0], target))
+
+    def resolve(domain, target):
+        if target == 'cloudfront':
+            dist = mgr.cloudfront_manager.get_matching_distributions(domain)
+            if not dist:
+                print(f'No CloudFront distribution found for {domain}.')
+                return None
+            return domain, DNS_Manager.CLOUDFRONT_ZONE_ID, dist['DomainName']
+        try:
+            region = mgr.bucket_manager.get_bucket_region(domain)
+        except ClientError as e:
+            print(f'Could not find bucket {domain}: {e}')
+            return None
+        endpoint = utils.get_endpoint(region)
+        if endpoint is None:
+            print(f'No website endpoint known for {domain} in {region}.')
+            return None
+        return domain, endpoint.dnszone, endpoint.site
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        targets = list(executor.map(lambda entry: resolve(*entry), entries))
+    unresolved = [d for (d, _), t in zip(entries, targets) if t is None]
+    changes, missing = mgr.dns_manager.sync_alias_records(
+        [t for t in targets if t is not None], wait, jobs)
+    print(f'Submitted {len(changes)} change batch(es) for '
+          f'{len(entries)} domain(s).')
+    if unresolved or missing:
+        raise click.ClickException(
+            'Not configured: ' + ', '.join(unresolved + missing))
+
+
+def configure_uploads(mgr, jobs, rehash, compress, compress_level,
+                      compress_types, cache_rules):
+    """Sizes the connection pool for `jobs` uploads and sets the ETag cache,
+    compression and Cache-Control rules uploads of the bucket manager use."""
+    from websync.compress import Compressor, DEFAULT_TYPES
+    from websync.etagcache import EtagCache
+    config.fit_pool(mgr.session_config.settings, jobs)
+    mgr.bucket_manager.etag_cache = EtagCache(rehash=rehash)
+    try:
+        policy = CachePolicy.from_specs(cache_rules)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--cache-control')
+    policy.rules.extend(config.load_cache_rules(mgr.config_path))
+    if policy.rules:
+        mgr.bucket_manager.cache_policy = policy
+    if compress:
+        mgr.bucket_manager.compressor = Compressor(
+            compress, compress_level, compress_types or DEFAULT_TYPES)
+
+
 @cli.command('sync-bucket')
 @click.argument('pathname', type=click.Path(exists=True))
 @click.argument('bucket')
+@click.option('--jobs', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of files to hash and upload concurrently.')
+@click.option('--rehash', is_flag=True,
+              help='Ignore cached ETags and hash every file again.')
+@click.option('--plan', 'plan_only', is_flag=True,
+              help='Print what would be synced as JSON without writing.')
+@click.option('--compress', default=None, type=click.Choice(['gzip', 'br']),
+              help='Upload text assets compressed with this encoding.')
+@click.option('--compress-level', type=int, default=None,
+              help='Compression level [default: 9 for gzip, 11 for br].')
+@click.option('--compress-type', 'compress_types', multiple=True,
+              help='Content type to compress, may be repeated '
+                   '[default: html, css, js, json, svg, xml, plain text].')
+@click.option('--cache-control', 'cache_rules', multiple=True,
+              metavar='PATTERN=VALUE',
+              help='Cache-Control for keys matching glob PATTERN, may be '
+                   'repeated; first match wins.  Rules from the '
+                   '[cache-control] config section apply after these.')
+@click.option('--invalidate', is_flag=True,
+              help='Invalidate changed keys in the CloudFront distribution '
+                   'for the domain matching the bucket name.')
+@click.option('--max-invalidation-paths', default=100, show_default=True,
+              help='Changed keys are merged into wildcards beyond this.')
+@click.option('--wait', is_flag=True,
+              help='Wait for the invalidation to complete.')
+@click.option('--backend', default='boto3', show_default=True,
+              type=click.Choice(['boto3', 'aio']),
+              help='aio drives --jobs requests from one event loop '
+                   '(requires aiobotocore).')
+@click.option('--resume/--no-resume', default=True, show_default=True,
+              help='Journal multipart uploads so an interrupted sync resumes '
+                   'them (boto3 backend).')
+@click.option('--dedupe', is_flag=True,
+              help='Copy files whose content is already in the bucket under '
+                   'another key instead of uploading them (boto3 backend).')
+@click.option('--max-bandwidth', default=None,
+              help='Bytes per second all uploads together may send, '
+                   'e.g. 10MB (boto3 backend).')
+@click.option('--max-request-rate', type=click.FloatRange(min=0.1),
+              default=None,
+              help='S3 requests per second, retries included (boto3 backend).')
+@click.option('--slowdown-backoff/--no-slowdown-backoff', default=True,
+              show_default=True,
+              help='Lower the request rate while S3 answers SlowDown '
+                   '(boto3 backend).')
+@click.option('--full-list', is_flag=True,
+              help='List the bucket even if the manifest snapshot of its last '
+                   'sync is up to date.')
+@click.option('--verify-sample', default=8, show_default=True,
+              type=click.IntRange(min=0),
+              help='Listing windows compared with the manifest snapshot '
+                   'before it is trusted.')
 @click.pass_obj
-def sync(mgr,pathname, bucket):
+def sync(mgr, pathname, bucket, jobs, rehash, plan_only, compress,
+         compress_level, compress_types, cache_rules, invalidate,
+         max_invalidation_paths, wait, backend, resume, dedupe, max_bandwidth,
+         max_request_rate, slowdown_backoff, full_list, verify_sample):
     """Syncs directory and subdirectories to specified s3 bucket"""
-    mgr.bucket_manager.sync_bucket(pathname, bucket)
+    configure_uploads(mgr, jobs, rehash, compress, compress_level,
+                      compress_types, cache_rules)
+    if backend == 'boto3':
+        from websync.snapshot import ManifestSnapshots
+        mgr.bucket_manager.snapshots = ManifestSnapshots()
+        mgr.bucket_manager.snapshot_samples = verify_sample
+    if backend == 'boto3' and (max_bandwidth or max_request_rate
+                               or slowdown_backoff):
+        from websync.throttle import Throttle
+        bytes_per_second = None
+        if max_bandwidth:
+            try:
+                bytes_per_second = config.parse_size(max_bandwidth) or None
+            except ValueError:
+                raise click.BadParameter(
+                    f'not a size: {max_bandwidth}', param_hint='--max-bandwidth')
+        mgr.bucket_manager.set_throttle(Throttle(
+            bytes_per_second, max_request_rate, slowdown_backoff, mgr.metrics))
+    if resume and not plan_only:
+        from websync.journal import UploadJournal
+        mgr.bucket_manager.journal = UploadJournal()
+    if plan_only:
+        summary = mgr.bucket_manager.plan_sync(
+            pathname, bucket, jobs, full_list)
+        print(json.dumps(summary, indent=2))
+        return
+    if backend == 'aio':
+        for name, value in (('--dedupe', dedupe),
+                            ('--max-bandwidth', max_bandwidth),
+                            ('--max-request-rate', max_request_rate)):
+            if value:
+                raise click.BadParameter(
+                    'requires the boto3 backend', param_hint=name)
+        import asyncio
+        # asyncio.run needs Python 3.7.
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(
+                aio_sync(mgr, pathname, bucket, jobs))
+        finally:
+            loop.close()
+    else:
+        result = mgr.bucket_manager.sync_bucket(
+            pathname, bucket, jobs, dedupe, full_list)
     print('Static website URL: ', mgr.bucket_manager.get_bucket_url(bucket))
+    if invalidate and result.changed:
+        mgr.cloudfront_manager.invalidate_paths(
+            bucket, result.changed, wait, max_invalidation_paths)
+    if result.failed:
+        raise click.ClickException(
+            f'{len(result.failed)} file(s) failed to sync: '
+            + ', '.join(key for key, _ in result.failed)
+        )
+
+
+async def aio_sync(mgr, pathname, bucket, jobs):
+    """Runs sync-bucket with the asyncio backend."""
+    from websync.aio import AsyncBucketManager
+    async with AsyncBucketManager(
+        mgr.profile,
+        endpoint_url=mgr.endpoint_url,
+        etag_cache=mgr.bucket_manager.etag_cache,
+        max_requests=jobs,
+        transfer_config=mgr.transfer_config,
+        compressor=mgr.bucket_manager.compressor,
+        cache_policy=mgr.bucket_manager.cache_policy,
+        metrics=mgr.metrics
+    ) as aio_manager:
+        return await aio_manager.sync_bucket(pathname, bucket, jobs)
+
+
+@cli.command('watch')
+@click.argument('pathname', type=click.Path(exists=True, file_okay=False))
+@click.argument('bucket')
+@click.option('--jobs', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of files to hash and upload concurrently.')
+@click.option('--rehash', is_flag=True,
+              help='Ignore cached ETags and hash every file again.')
+@click.option('--debounce', default=0.5, show_default=True,
+              type=click.FloatRange(min=0),
+              help='Seconds without file events that end a batch.')
+@click.option('--max-delay', default=5.0, show_default=True,
+              type=click.FloatRange(min=0),
+              help='Longest a batch waits for events to stop.')
+@click.option('--poll', is_flag=True,
+              help='Poll the tree instead of using file system events '
+                   '(the default without watchdog).')
+@click.option('--poll-interval', default=1.0, show_default=True,
+              type=click.FloatRange(min=0.05),
+              help='Seconds between scans of the tree when polling.')
+@click.option('--compress', default=None, type=click.Choice(['gzip', 'br']),
+              help='Upload text assets compressed with this encoding.')
+@click.option('--compress-level', type=int, default=None,
+              help='Compression level [default: 9 for gzip, 11 for br].')
+@click.option('--compress-type', 'compress_types', multiple=True,
+              help='Content type to compress, may be repeated.')
+@click.option('--cache-control', 'cache_rules', multiple=True,
+              metavar='PATTERN=VALUE',
+              help='Cache-Control for keys matching glob PATTERN, may be '
+                   'repeated; first match wins.')
+@click.option('--invalidate', is_flag=True,
+              help='Invalidate changed keys in the CloudFront distribution '
+                   'for the domain matching the bucket name.')
+@click.option('--max-invalidation-paths', default=100, show_default=True,
+              help='Changed keys are merged into wildcards beyond this.')
+@click.pass_obj
+def watch(mgr, pathname, bucket, jobs, rehash, debounce, max_delay, poll,
+          poll_interval, compress, compress_level, compress_types,
+          cache_rules, invalidate, max_invalidation_paths):
+    """Syncs directory to s3 bucket, then re-syncs files as they change."""
+    from websync.watch import SiteWatcher
+    configure_uploads(mgr, jobs, rehash, compress, compress_level,
+                      compress_types, cache_rules)
+
+    def on_change(result):
+        mgr.cloudfront_manager.invalidate_paths(
+            bucket, result.changed, False, max_invalidation_paths)
+
+    watcher = SiteWatcher(
+        mgr.bucket_manager, pathname, bucket, jobs, debounce, max_delay,
+        poll_interval, poll, on_change if invalidate else None)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print('Stopped watching.')
 
 
 @cli.command('tag-bucket')
@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Timers, counters and AWS call latency for websync runs.
+
+A Metrics object is shared by the managers of one run:
+
+    metrics.incr('bytes_uploaded', size)
+    with metrics.timer('hash'):
+        ...
+    metrics.instrument(client)   # counts and times every API call
+
+and written as JSON lines or as a Prometheus textfile with write().
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'websync_'
+
+
+class Histogram:
+    """Counts observations per latency bucket."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns [(upper bound, observations <= bound)] ending at +Inf."""
+        total = 0
+        buckets = []
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class Metrics:
+    """Thread safe collection of counters and histograms.
+
+    Each metric is identified by a name and optional labels, e.g.
+    incr('api_requests', operation='s3.PutObject').  Phase timers are
+    histograms named phase_seconds with a phase label.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def value(self, name, **labels):
+        """Returns the current value of a counter, 0 if never incremented."""
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, phase):
+        """Times the block as one observation of phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('phase_seconds', time.perf_counter() - start,
+                         phase=phase)
+
+    def timed_iter(self, phase, iterable):
+        """Yields from iterable, recording the time spent producing items
+        as one observation of phase once it is exhausted."""
+        elapsed = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        except StopIteration:
+            return
+        finally:
+            self.observe('phase_seconds', elapsed, phase=phase)
+
+    def instrument(self, client):
+        """Counts requests, retries and errors of every call made by a
+        botocore client and records their latency."""
+        events = client.meta.events
+        events.register('before-call', self._before_call)
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+
+    def _before_call(self, model, context, **kwargs):
+        context['websync_operation'] = \
+            f'{model.service_model.service_name}.{model.name}'
+        context['websync_started'] = time.perf_counter()
+
+    def _after_call(self, context, parsed, **kwargs):
+        operation = self._finish(context)
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            self.incr('api_retries', retries, operation=operation)
+        if 'Error' in parsed:
+            self.incr('api_errors', operation=operation,
+                      code=parsed['Error'].get('Code', 'Unknown'))
+
+    def _after_call_error(self, context, exception, **kwargs):
+        operation = self._finish(context)
+        self.incr('api_errors', operation=operation,
+                  code=type(exception).__name__)
+
+    def _finish(self, context):
+        """Records a finished call.  Returns its operation name."""
+        operation = context.get('websync_operation', 'unknown')
+        self.incr('api_requests', operation=operation)
+        started = context.pop('websync_started', None)
+        if started is not None:
+            self.observe('api_latency_seconds',
+                         time.perf_counter() - started, operation=operation)
+        return operation
+
+    def snapshot(self):
+        """Returns a list of metric dicts."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: (h.cumulative(), h.sum, h.count)
+                for key, h in self.histograms.items()
+            }
+        metrics = []
+        for (name, labels), value in sorted(counters.items()):
+            metrics.append({
+                'type': 'counter',
+                'name': name,
+                'labels': dict(labels),
+                'value': value,
+            })
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            metrics.append({
+                'type': 'histogram',
+                'name': name,
+                'labels': dict(labels),
+                'count': count,
+                'sum': round(total, 6),
+                'buckets': {str(bound): n for bound, n in buckets},
+            })
+        return metrics
+
+    def write_json(self, path, **info):
+        """Appends one JSON line per metric to path.  info, e.g. the
+        command name, is added to every line."""
+        now = time.time()
+        with open(path, 'a') as f:
+            for metric in self.snapshot():
+                line = dict(info, time=now, run_seconds=round(now - self.started, 6))
+                line.update(metric)
+                f.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def format_prometheus(self):
+        """Returns metrics in the Prometheus text exposition format."""
+        def labels_text(labels, **extra):
+            items = dict(labels, **extra)
+            if not items:
+                return ''
+            return '{' + ','.join(
+                '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in sorted(items.items())
+            ) + '}'
+
+        lines = []
+        typed = set()
+        for metric in self.snapshot():
+            labels = metric['labels']
+            if metric['type'] == 'counter':
+                name = PREFIX + metric['name'] + '_total'
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{labels_text(labels)} {metric["value"]}')
+                continue
+            name = PREFIX + metric['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, count in metric['buckets'].items():
+                lines.append(
+                    f'{name}_bucket{labels_text(labels, le=bound)} {count}')
+            lines.append(f'{name}_sum{labels_text(labels)} {metric["sum"]}')
+            lines.append(f'{name}_count{labels_text(labels)} {metric["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Replaces path with a Prometheus textfile, atomically so a
+        collector never reads a partial file."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.format_prometheus())
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def write(self, path, **info):
+        """Writes a Prometheus textfile if path ends in .prom, otherwise
+        appends JSON lines."""
+        if path.endswith('.prom'):
+            self.write_prometheus(path)
+        else:
+            self.write_json(path, **info)
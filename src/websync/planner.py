@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Plans a sync by merging a sorted local walk with a bucket listing.
+
+list_objects_v2 returns keys in lexicographic (UTF-8 byte) order, so when
+the local tree is walked in the same order both sides can be merged one
+entry at a time without holding either side in memory.
+"""
+
+import os
+from collections import namedtuple
+
+# websync keeps its own objects under this prefix.  They are never
+# synced, so a sync does not delete them.
+STATE_PREFIX = '.websync/'
+STATE_KEY = STATE_PREFIX + 'state'
+
+UPLOAD = 'upload'
+UPDATE = 'update'
+DELETE = 'delete'
+
+Action = namedtuple('Action', ['kind', 'key', 'path', 'etag'])
+Action.__doc__ = """A sync step for key.
+
+UPLOAD: key only exists locally at path.
+UPDATE: key exists on both sides, etag is the bucket's ETag.
+DELETE: key only exists in the bucket.
+"""
+
+
+class SyncResult:
+    """Outcome of a sync.
+
+    uploaded and deleted list keys written to or removed from the bucket,
+    including metadata-only updates.  etags maps written keys to their new
+    ETags.  failed lists (key, error) pairs.
+    """
+
+    def __init__(self):
+        self.uploaded = []
+        self.etags = {}
+        self.deleted = []
+        self.skipped = 0
+        self.failed = []
+
+    @property
+    def changed(self):
+        return self.uploaded + self.deleted
+
+
+def _sort_key(entry):
+    # A directory's keys all start with "name/", so sorting directories by
+    # that prefix keeps the walk in the same order as the bucket listing.
+    if entry.is_dir():
+        return entry.name + '/'
+    return entry.name
+
+
+def walk_local(root, prefix=''):
+    """Yields (key, path) for files under root in s3 key order."""
+    with os.scandir(root) as it:
+        entries = sorted(it, key=_sort_key)
+    for entry in entries:
+        key = prefix + entry.name
+        if entry.is_dir():
+            if key + '/' != STATE_PREFIX:
+                yield from walk_local(entry.path, key + '/')
+        else:
+            yield key, entry.path
+
+
+def walk_remote(client, bucket, prefix=''):
+    """Yields (key, etag) for objects in bucket one page at a time."""
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].startswith(STATE_PREFIX):
+                yield obj['Key'], obj['ETag']
+
+
+def plan(local, remote):
+    """Merges sorted local (key, path) and remote (key, etag) iterators
+    into a stream of Actions."""
+    local = iter(local)
+    remote = iter(remote)
+    lkey, path = next(local, (None, None))
+    rkey, etag = next(remote, (None, None))
+    while lkey is not None or rkey is not None:
+        if rkey is None or (lkey is not None and lkey < rkey):
+            yield Action(UPLOAD, lkey, path, None)
+            lkey, path = next(local, (None, None))
+        elif lkey is None or rkey < lkey:
+            yield Action(DELETE, rkey, None, etag)
+            rkey, etag = next(remote, (None, None))
+        else:
+            yield Action(UPDATE, lkey, path, etag)
+            lkey, path = next(local, (None, None))
+            rkey, etag = next(remote, (None, None))
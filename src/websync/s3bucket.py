@@ -3,29 +3,91 @@
 
 """Classes to manage S3 Buckets."""
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+import json
+import math
 import mimetypes
-import boto3
-from functools import reduce
+import os
+import random
+import threading
+import time
+import uuid
+from boto3.s3.transfer import TransferConfig
 from hashlib import md5
 from botocore.exceptions import ClientError
-from websync import utils
+from websync import hashing, planner, utils
+from websync.metrics import Metrics
+
+class StateMarkerGuard:
+    """Call before each write to a bucket: clears its state marker the
+    first time, so no snapshot is trusted once the bucket changes."""
+
+    def __init__(self, bucket_manager, bucket_name):
+        self.bucket_manager = bucket_manager
+        self.bucket_name = bucket_name
+        self.cleared = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if not self.cleared:
+                self.bucket_manager.clear_state_marker(self.bucket_name)
+                self.cleared = True
+
 
 class BucketManager:
     """Methods to manage S3 buckets."""
 
     CHUNK_SIZE = 8388608
+    DELETE_BATCH_SIZE = 1000
+    DELETE_MAX_ATTEMPTS = 5
+    # Smaller duplicates are uploaded, a copy saves too little to matter.
+    DEDUPE_MIN_SIZE = 64 * 1024
+    # Headers set by prepare_upload that can change without the body.
+    METADATA_ARGS = ('CacheControl', 'ContentEncoding', 'ContentType')
+    # Listing windows compared with a manifest snapshot before it is
+    # trusted, and keys per window.
+    SNAPSHOT_SAMPLES = 8
+    SNAPSHOT_WINDOW = 1000
+    # S3 Standard price per PUT, COPY, POST or LIST request in USD.
+    PUT_REQUEST_PRICE = 0.005 / 1000
+    # S3 Standard price per GET or HEAD request in USD.
+    GET_REQUEST_PRICE = 0.0004 / 1000
+    RETRY_ERROR_CODES = (
+        'SlowDown',
+        'InternalError',
+        'ServiceUnavailable',
+        'RequestTimeout',
+        'Throttling',
+    )
 
-    def __init__(self, session):
+    def __init__(self, session, etag_cache=None, endpoint_url=None,
+                 config=None, transfer_config=None, compressor=None,
+                 cache_policy=None, metrics=None, journal=None,
+                 throttle=None, snapshots=None):
         self.session = session
-        self.s3 = self.session.resource('s3')
+        self.etag_cache = etag_cache
+        self.journal = journal
+        self.snapshots = snapshots
+        self.snapshot_samples = self.SNAPSHOT_SAMPLES
+        self.compressor = compressor
+        self.cache_policy = cache_policy
+        self.s3 = self.session.resource(
+            's3', endpoint_url=endpoint_url, config=config)
+        self.metrics = metrics or Metrics()
+        self.metrics.instrument(self.s3.meta.client)
+        self.throttle = None
+        if throttle is not None:
+            self.set_throttle(throttle)
 
-        self.transfer_config = boto3.s3.transfer.TransferConfig(
+        self.transfer_config = transfer_config or TransferConfig(
             multipart_chunksize=self.CHUNK_SIZE,
             multipart_threshold=self.CHUNK_SIZE
         )
         self.manifest = {}
-        self.local_files = []
 
     def all_buckets(self):
         """Gets an iterator for all s3 buckets."""
@@ -53,22 +115,361 @@ class BucketManager:
         self.new_bucket.wait_until_exists()
         return self.new_bucket
 
-    def file_upload(self, bucket_name, path, key):
-        """Uploads file to s3 bucket at key."""
-        etag = self.get_file_etag(path)
-        if self.manifest.get(key, '') == etag:
-            print('Skipping', key, 'already exists in', bucket_name)
-            return
+    def delete_batch(self, bucket_name, keys):
+        """Deletes up to DELETE_BATCH_SIZE keys from s3 bucket.
+        Keys that fail with a throttling or transient error are retried with
+        backoff.  Returns (deleted count, list of (key, error))."""
+        deleted = 0
+        failed = []
+        for attempt in range(self.DELETE_MAX_ATTEMPTS):
+            try:
+                response = self.s3.meta.client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={
+                        'Objects': [{'Key': k} for k in keys],
+                        'Quiet': True
+                    }
+                )
+                errors = [
+                    (e['Key'], e['Code'], e.get('Message', ''))
+                    for e in response.get('Errors', [])
+                ]
+            except ClientError as e:
+                error = e.response['Error']
+                errors = [
+                    (k, error['Code'], error.get('Message', '')) for k in keys
+                ]
+            deleted += len(keys) - len(errors)
+            keys = []
+            for key, code, message in errors:
+                if code in self.RETRY_ERROR_CODES:
+                    keys.append(key)
+                else:
+                    failed.append((key, f'{code}: {message}'))
+            if not keys:
+                break
+            if attempt + 1 < self.DELETE_MAX_ATTEMPTS:
+                time.sleep(min(20, 0.2 * 2 ** attempt) * random.uniform(0.5, 1))
+        failed.extend((key, 'Retries exhausted') for key in keys)
+        return deleted, failed
+
+    def delete_keys(self, bucket_name, keys, jobs=1):
+        """Deletes keys from s3 bucket in concurrent batches.
+        Returns a list of (key, error) for keys that could not be deleted."""
+        keys = iter(keys)
+        batches = iter(
+            lambda: list(islice(keys, self.DELETE_BATCH_SIZE)), []
+        )
+        deleted = 0
+        failed = []
+        with self.metrics.timer('delete'), \
+                ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for count, errors in executor.map(
+                lambda batch: self.delete_batch(bucket_name, batch), batches
+            ):
+                deleted += count
+                failed.extend(errors)
+        self.metrics.incr('files_deleted', deleted)
+        for key, error in failed:
+            print(f'Failed to remove {key} from {bucket_name}: {error}')
+        print(f'Removed {deleted} object(s) from {bucket_name}, '
+              f'{len(failed)} failed.')
+        return failed
+
+    def file_upload(self, bucket_name, path, key, remote_etag=None,
+                    etag_index=None, before_write=None):
+        """Uploads file to s3 bucket at key unless remote_etag, or the
+        manifest entry for key, shows it is already there.  With an
+        etag_index of ETag -> key, a file another object already holds is
+        copied server side instead of uploaded.  before_write is called
+        before the object's content is changed.
+        Returns the object's new ETag if it was written, else None."""
+        path, extra_args = self.prepare_upload(path, key)
+        with self.metrics.timer('hash'):
+            etag = self.get_file_etag(path)
+        if remote_etag is None:
+            remote_etag = self.manifest.get(key, '')
+        if remote_etag == etag:
+            if self.cache_policy is not None and not self.headers_current(
+                    bucket_name, key, etag, extra_args):
+                print(f'Updating metadata of {key} in {bucket_name}')
+                self.update_metadata(bucket_name, key, extra_args)
+                self.record_headers(bucket_name, key, etag, extra_args)
+                self.metrics.incr('metadata_updates')
+                return etag
+            print(f'Skipping {key} already exists in {bucket_name}')
+            return None
+        if before_write is not None:
+            before_write()
+        size = os.path.getsize(path)
+        if etag_index is not None and size >= self.DEDUPE_MIN_SIZE:
+            source = etag_index.get(etag)
+            if source is not None and source != key and self.copy_duplicate(
+                    bucket_name, source, key, etag, extra_args):
+                self.metrics.incr('files_copied')
+                self.metrics.incr('bytes_copied', size)
+                self.record_headers(bucket_name, key, etag, extra_args)
+                return etag
         print(f'Uploading {key} to {bucket_name} bucket.')
-        self.s3.Bucket(bucket_name).upload_file(
-            path,
+        with self.metrics.timer('upload'):
+            if self.journal is not None \
+                    and size >= self.transfer_config.multipart_threshold:
+                self.resumable_upload(bucket_name, path, key, extra_args)
+            else:
+                # The client is thread safe, resource objects are not.
+                self.s3.meta.client.upload_file(
+                    path,
+                    bucket_name,
+                    key,
+                    ExtraArgs=extra_args,
+                    Callback=self.throttle.consume_bytes if self.throttle else None,
+                    Config=self.transfer_config
+                )
+                self.metrics.incr('bytes_uploaded', size)
+        if etag_index is not None:
+            etag_index.setdefault(etag, key)
+        self.record_headers(bucket_name, key, etag, extra_args)
+        return etag
+
+    def copy_duplicate(self, bucket_name, source, key, etag, extra_args):
+        """Copies object source to key if source still has etag.
+        Returns False if source changed or is gone, so key is uploaded."""
+        print(f'Copying {source} to {key} in {bucket_name}')
+        try:
+            self.copy_object(bucket_name, source, key, dict(
+                extra_args, CopySourceIfMatch=etag))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in (
+                    'PreconditionFailed', '412', 'NoSuchKey', '404'):
+                raise
+            print(f'{source} changed, uploading {key} instead.')
+            return False
+        return True
+
+    def resumable_upload(self, bucket_name, path, key, extra_args):
+        """Uploads path in parts of the size s3transfer would use, so the
+        ETag matches get_file_etag.  Each part is recorded in the journal;
+        an upload interrupted earlier is resumed, skipping parts that
+        list_parts shows s3 already has."""
+        client = self.s3.meta.client
+        size = os.path.getsize(path)
+        chunk = hashing.part_size(size, self.transfer_config.multipart_chunksize)
+        upload_id = None
+        done = {}
+        entry = self.journal.get(bucket_name, key)
+        if entry is not None:
+            if self.journal.matches(entry, path, chunk, extra_args):
+                try:
+                    listed = self.get_uploaded_parts(
+                        bucket_name, key, entry['upload_id'])
+                    upload_id = entry['upload_id']
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'NoSuchUpload':
+                        raise
+                    self.journal.remove(bucket_name, key)
+                else:
+                    recorded = self.journal.get_parts(upload_id)
+                    done = {
+                        number: etag for number, etag in listed.items()
+                        if recorded.get(number) == etag
+                    }
+            else:
+                self.abort_upload(bucket_name, key, entry['upload_id'])
+
+        if upload_id is None:
+            upload_id = client.create_multipart_upload(
+                Bucket=bucket_name, Key=key, **extra_args)['UploadId']
+            self.journal.start(
+                bucket_name, key, upload_id, path, chunk, extra_args)
+        else:
+            print(f'Resuming upload of {key}: {len(done)} part(s) '
+                  f'already in {bucket_name}.')
+            self.metrics.incr('uploads_resumed')
+            self.metrics.incr('parts_resumed', len(done))
+
+        def upload_part(number):
+            if number in done:
+                return done[number]
+            with open(path, 'rb') as f:
+                f.seek((number - 1) * chunk)
+                data = f.read(chunk)
+            if self.throttle is not None:
+                self.throttle.consume_bytes(len(data))
+            etag = client.upload_part(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=data
+            )['ETag']
+            self.journal.add_part(upload_id, number, etag)
+            self.metrics.incr('bytes_uploaded', len(data))
+            return etag
+
+        numbers = range(1, math.ceil(size / chunk) + 1)
+        workers = self.transfer_config.max_concurrency \
+            if self.transfer_config.use_threads else 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            etags = list(executor.map(upload_part, numbers))
+        client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'ETag': etag, 'PartNumber': number}
+                for number, etag in zip(numbers, etags)
+            ]}
+        )
+        self.journal.remove(bucket_name, key)
+
+    def get_uploaded_parts(self, bucket_name, key, upload_id):
+        """Returns {part number: ETag} of parts s3 has for upload_id."""
+        paginator = self.s3.meta.client.get_paginator('list_parts')
+        parts = {}
+        for page in paginator.paginate(
+                Bucket=bucket_name, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+        return parts
+
+    def abort_upload(self, bucket_name, key, upload_id):
+        """Aborts a journaled multipart upload and forgets it."""
+        print(f'Aborting stale upload of {key} in {bucket_name}.')
+        try:
+            self.s3.meta.client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+        self.journal.remove(bucket_name, key)
+        self.metrics.incr('uploads_aborted')
+
+    def abort_stale_uploads(self, bucket_name, keep=()):
+        """Aborts journaled uploads to bucket except those for keys in keep.
+        Called once a sync has tried every file, so the uploads left are
+        for files that are gone or no longer need uploading."""
+        for entry in self.journal.uploads(bucket_name):
+            if entry['key'] not in keep:
+                self.abort_upload(bucket_name, entry['key'], entry['upload_id'])
+
+    def prepare_upload(self, path, key):
+        """Returns (path, ExtraArgs) to upload key with.  path is replaced
+        by its compressed copy when key is compressed."""
+        content_type = mimetypes.guess_type(key)[0]
+        extra_args = {'ContentType': content_type or 'text/plain'}
+        # Files of unknown type are served as text/plain, but may well be
+        # binary, so only compress what is known to be text.
+        if self.compressor is not None and content_type is not None \
+                and self.compressor.should_compress(content_type):
+            path = self.compressor.compress(path)
+            extra_args['ContentEncoding'] = self.compressor.encoding
+        if self.cache_policy is not None:
+            cache_control = self.cache_policy.get(key)
+            if cache_control:
+                extra_args['CacheControl'] = cache_control
+        return path, extra_args
+
+    @classmethod
+    def headers_digest(cls, extra_args):
+        """Returns a digest of the headers in extra_args that can change
+        without the body."""
+        headers = {name: extra_args.get(name) for name in cls.METADATA_ARGS}
+        return md5(json.dumps(headers, sort_keys=True).encode()).hexdigest()
+
+    def record_headers(self, bucket_name, key, etag, extra_args):
+        """Remembers the headers written to key in the ETag cache."""
+        if self.etag_cache is not None:
+            self.etag_cache.set_headers(
+                bucket_name, key, etag, self.headers_digest(extra_args))
+
+    def headers_current(self, bucket_name, key, etag, extra_args):
+        """Returns True if object key has the headers extra_args would set.
+        Only asks s3 when the ETag cache does not know that websync already
+        applied these headers to the object as it is."""
+        if self.etag_cache is not None and self.etag_cache.get_headers(
+                bucket_name, key, etag) == self.headers_digest(extra_args):
+            return True
+        if self.metadata_changed(bucket_name, key, extra_args):
+            return False
+        self.record_headers(bucket_name, key, etag, extra_args)
+        return True
+
+    def metadata_changed(self, bucket_name, key, extra_args):
+        """Returns True if the headers of object key differ from the ones
+        extra_args would set."""
+        head = self.s3.meta.client.head_object(Bucket=bucket_name, Key=key)
+        return any(
+            head.get(name) != extra_args.get(name)
+            for name in self.METADATA_ARGS
+        )
+
+    def update_metadata(self, bucket_name, key, extra_args):
+        """Replaces headers of object key with a server side copy onto
+        itself, so the body is not uploaded again."""
+        self.copy_object(bucket_name, key, key, extra_args)
+
+    def copy_object(self, bucket_name, source, key, extra_args):
+        """Server side copy of source to key with headers from extra_args.
+        Large objects are copied in parts of the configured chunk size, so
+        the copy gets the ETag an upload would have."""
+        self.s3.meta.client.copy(
+            {'Bucket': bucket_name, 'Key': source},
+            bucket_name,
             key,
-            ExtraArgs={
-                'ContentType': mimetypes.guess_type(key)[0] or 'text/plain'
-            },
+            ExtraArgs=dict(extra_args, MetadataDirective='REPLACE'),
             Config=self.transfer_config
         )
 
+    def upload_files(self, bucket_name, files, jobs=1, result=None,
+                     etag_index=None, before_write=None):
+        """Uploads (path, key, remote_etag) items to s3 bucket using a pool
+        of workers.  files can be a lazy iterator.
+        Returns a SyncResult of uploaded, skipped and failed keys."""
+        result = result or planner.SyncResult()
+        for (path, key, remote_etag), future in self.map_bounded(
+            lambda *item: self.file_upload(
+                bucket_name, *item, etag_index=etag_index,
+                before_write=before_write),
+            files, jobs
+        ):
+            try:
+                etag = future.result()
+                if etag:
+                    result.uploaded.append(key)
+                    result.etags[key] = etag
+                    self.metrics.incr('files_uploaded')
+                else:
+                    result.skipped += 1
+                    self.metrics.incr('files_skipped')
+            except Exception as e:
+                print(f'Failed to upload {key} to {bucket_name}: {e}')
+                result.failed.append((key, e))
+                self.metrics.incr('files_failed')
+        return result
+
+    @staticmethod
+    def map_bounded(func, items, jobs=1):
+        """Runs func(*item) for each item on a pool of `jobs` workers.
+        Yields (item, future) in input order, queueing only a few items per
+        worker so items can be a lazy iterator."""
+        jobs = max(jobs, 1)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for item in items:
+                pending.append((item, executor.submit(func, *item)))
+                if len(pending) >= jobs * 4:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    def multipart_parts(self, size):
+        """Returns number of parts an upload of size bytes is split into,
+        or 0 if it is uploaded with a single PUT."""
+        if size < self.transfer_config.multipart_threshold:
+            return 0
+        return math.ceil(size / hashing.part_size(
+            size, self.transfer_config.multipart_chunksize))
+
     def get_bucket_name(self, bucket):
         """Returns the buckets name"""
         return self.s3.Bucket(bucket).name
@@ -99,25 +500,204 @@ class BucketManager:
         return hash
 
     def get_file_etag(self, filepath):
-        """Gets etag for a file."""
-        hashes = []
-        with open(filepath, 'rb') as f:
-            while True:
-                data = f.read(self.CHUNK_SIZE)
-                if not data:
-                    break
-
-                hashes.append(self.get_data_hash(data))
-        if not hashes:
+        """Gets etag for a file, using the etag cache when one is set."""
+        return hashing.cached_file_etag(
+            filepath,
+            self.transfer_config.multipart_chunksize,
+            self.transfer_config.multipart_threshold,
+            self.etag_cache
+        )
+
+    def hash_file_etag(self, filepath):
+        """Computes etag for a file by reading its contents."""
+        return hashing.file_etag(
+            filepath,
+            self.transfer_config.multipart_chunksize,
+            self.transfer_config.multipart_threshold
+        )
+
+    def get_state_token(self, bucket_name):
+        """Returns the token of the bucket's state marker, or None."""
+        try:
+            body = self.s3.meta.client.get_object(
+                Bucket=bucket_name, Key=planner.STATE_KEY)['Body'].read()
+            return json.loads(body)['token']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+        except (ValueError, KeyError):
+            pass
+        return None
+
+    def put_state_marker(self, bucket_name, token):
+        self.s3.meta.client.put_object(
+            Bucket=bucket_name,
+            Key=planner.STATE_KEY,
+            Body=json.dumps({'token': token, 'time': time.time()}),
+            ContentType='application/json',
+            CacheControl='no-store'
+        )
+
+    def clear_state_marker(self, bucket_name):
+        """Removes the state marker, if there is one, so no snapshot is
+        trusted while the bucket changes.  Deleting a missing key would
+        still add a delete marker to a versioned bucket."""
+        client = self.s3.meta.client
+        try:
+            client.head_object(Bucket=bucket_name, Key=planner.STATE_KEY)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
             return
-        elif len(hashes) == 1:
-            return '"{}"'.format(hashes[0].hexdigest())
-        else:
-            hash = self.get_data_hash(
-                reduce(lambda x, y: x + y, (h.digest() for h in hashes))
-                )
+        client.delete_object(Bucket=bucket_name, Key=planner.STATE_KEY)
+
+    def snapshot_matches(self, bucket_name):
+        """Lists a window of keys from the start of the bucket and after
+        randomly sampled keys of its snapshot.  Returns True if every
+        window matches the snapshot."""
+        samples = self.snapshot_samples
+        if samples <= 0:
+            return True
+        starts = [''] + self.snapshots.sample(bucket_name, samples - 1)
+        client = self.s3.meta.client
+
+        def matches(start):
+            page = client.list_objects_v2(
+                Bucket=bucket_name, StartAfter=start,
+                MaxKeys=self.SNAPSHOT_WINDOW)
+            contents = page.get('Contents', [])
+            listed = [
+                (obj['Key'], obj['ETag']) for obj in contents
+                if not obj['Key'].startswith(planner.STATE_PREFIX)
+            ]
+            if page.get('IsTruncated'):
+                until = contents[-1]['Key']
+                return listed == self.snapshots.window(
+                    bucket_name, start, until)
+            return listed == self.snapshots.window(
+                bucket_name, start, limit=len(listed) + 1)
+
+        with ThreadPoolExecutor(max_workers=len(starts)) as executor:
+            return all(executor.map(matches, starts))
+
+    def trusted_snapshot(self, bucket_name):
+        """Returns the token of the bucket's manifest snapshot if its token
+        matches the bucket's state marker and sampled listing windows agree
+        with it, else None."""
+        token = self.snapshots.get_token(bucket_name)
+        if token is None or token != self.get_state_token(bucket_name):
+            return None
+        with self.metrics.timer('verify_snapshot'):
+            trusted = self.snapshot_matches(bucket_name)
+        if trusted:
+            print(f'Using manifest snapshot of {bucket_name}.')
+            self.metrics.incr('snapshot_hits')
+            return token
+        print(f'Manifest snapshot of {bucket_name} is out of date, '
+              'listing the bucket.')
+        self.metrics.incr('snapshot_drifts')
+        return None
+
+    def remote_objects(self, bucket_name, full_list=False, record=False,
+                       token=None):
+        """Returns an iterator of (key, etag) of the bucket in key order.
+        The manifest snapshot is used instead of listing the bucket when
+        it is trusted, or its token is given.  With record, a listing is
+        stored as the bucket's new snapshot as it is read."""
+        snapshots = self.snapshots
+        if snapshots is not None and not full_list:
+            if token is None:
+                token = self.trusted_snapshot(bucket_name)
+            if token is not None:
+                return self.metrics.timed_iter(
+                    'list', snapshots.objects(bucket_name))
+        remote = self.metrics.timed_iter(
+            'list', planner.walk_remote(self.s3.meta.client, bucket_name))
+        if snapshots is not None and record:
+            remote = snapshots.record(bucket_name, remote)
+        return remote
+
+    def plan_sync(self, pathname, bucket, jobs=1, full_list=False):
+        """Returns a summary of what sync_bucket would do.
+        Only reads the bucket and hashes local files, nothing is written.
+        Request counts include the listing or snapshot verification."""
+        root = Path(pathname).expanduser().resolve()
+        summary = {
+            'bucket': bucket,
+            'uploads': 0,
+            'skips': 0,
+            'deletes': 0,
+            'metadata_updates': 0,
+            'upload_bytes': 0,
+            'multipart_uploads': 0,
+            'put_requests': 0,
+            'delete_requests': 0,
+            'list_requests': 0,
+            'get_requests': 0,
+        }
+
+        def requests(operation):
+            return self.metrics.value('api_requests', operation=operation)
+
+        # The bucket is read as sync_bucket would read it, from a trusted
+        # snapshot after a few verification requests or by listing it, so
+        # count the requests actually made.
+        lists, gets = requests('s3.ListObjectsV2'), \
+            requests('s3.GetObject') + requests('s3.HeadObject')
+
+        def changes():
+            local = self.metrics.timed_iter('walk', planner.walk_local(root))
+            for action in planner.plan(
+                    local, self.remote_objects(bucket, full_list)):
+                if action.kind == planner.DELETE:
+                    summary['deletes'] += 1
+                else:
+                    yield action
 
-            return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
+        def compare(kind, key, path, etag):
+            """Returns (outcome, bytes to upload) for one file."""
+            path, extra_args = self.prepare_upload(path, key)
+            with self.metrics.timer('hash'):
+                unchanged = kind == planner.UPDATE \
+                    and self.get_file_etag(path) == etag
+            if unchanged:
+                if self.cache_policy is not None and not self.headers_current(
+                        bucket, key, etag, extra_args):
+                    return 'metadata', 0
+                return 'skip', 0
+            return 'upload', os.path.getsize(path)
+
+        for action, future in self.map_bounded(compare, changes(), jobs):
+            outcome, size = future.result()
+            if outcome == 'skip':
+                summary['skips'] += 1
+                continue
+            if outcome == 'metadata':
+                summary['metadata_updates'] += 1
+                summary['put_requests'] += 1
+                continue
+            parts = self.multipart_parts(size)
+            summary['uploads'] += 1
+            summary['upload_bytes'] += size
+            if parts:
+                summary['multipart_uploads'] += 1
+                # CreateMultipartUpload, UploadPart * parts, Complete.
+                summary['put_requests'] += parts + 2
+            else:
+                summary['put_requests'] += 1
+
+        summary['delete_requests'] = math.ceil(
+            summary['deletes'] / self.DELETE_BATCH_SIZE)
+        summary['list_requests'] = requests('s3.ListObjectsV2') - lists
+        summary['get_requests'] = requests('s3.GetObject') \
+            + requests('s3.HeadObject') - gets
+        summary['estimated_request_cost_usd'] = round(
+            (summary['put_requests'] + summary['list_requests'])
+            * self.PUT_REQUEST_PRICE
+            + summary['get_requests'] * self.GET_REQUEST_PRICE, 6)
+        if self.etag_cache is not None:
+            self.etag_cache.save()
+        return summary
 
     def remove_bucket_tag(self, bucket_name, key, value):
         """Removes tag from specified s3 bucket."""
@@ -136,8 +716,9 @@ class BucketManager:
         except:
             print(f'{bucket_name} does not appear to have a {key} tag set.')
 
-    def set_bucket_policy(self, bucket_name):
-        """Sets bucket policy for *.html to be public."""
+    @staticmethod
+    def public_bucket_policy(bucket_name):
+        """Returns bucket policy that makes website files public."""
         policy = """
             {
                 "Version": "2012-10-17",
@@ -159,8 +740,12 @@ class BucketManager:
                     }
                 ]
             }
-            """   # % self.s3.Bucket(bucket_name).name
-        policy = policy.replace('%s', self.s3.Bucket(bucket_name).name).strip()
+            """
+        return policy.replace('%s', bucket_name).strip()
+
+    def set_bucket_policy(self, bucket_name):
+        """Sets bucket policy for *.html to be public."""
+        policy = self.public_bucket_policy(self.s3.Bucket(bucket_name).name)
         pol = self.s3.Bucket(bucket_name).Policy()
         pol.put(Policy=policy)
 
@@ -216,10 +801,13 @@ class BucketManager:
 
     def set_bucket_manifest(self, bucket):
         """Loads manifest for caching purposes."""
-        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket):
-            for obj in page.get('Contents', []):
-                self.manifest[obj['Key']] = obj['ETag']
+        for key, etag in self.remote_objects(bucket):
+            self.manifest[key] = etag
+
+    def set_throttle(self, throttle):
+        """Makes uploads and requests of this manager wait for throttle."""
+        self.throttle = throttle
+        throttle.instrument(self.s3.meta.client)
 
     def set_bucket_versioning(self, bucket_name):
         """Enables multiple versions of an object in the same bucket."""
@@ -240,44 +828,94 @@ class BucketManager:
         """Suspends bucket versioning."""
         self.s3.BucketVersioning(bucket_name).suspend()
 
-    def sync_bucket(self, pathname, bucket):
-        """Sync contents of pathname to s3 bucket."""
+    @staticmethod
+    def record_manifest(remote, manifest):
+        """Yields from the (key, etag) iterator remote, storing each pair
+        in the dict manifest."""
+        for key, etag in remote:
+            manifest[key] = etag
+            yield key, etag
+
+    def sync_bucket(self, pathname, bucket, jobs=1, dedupe=False,
+                    full_list=False, manifest=None):
+        """Sync contents of pathname to s3 bucket.
+        The bucket listing and local walk are merged as they are read, and
+        files are hashed and uploaded by up to `jobs` workers.  With dedupe
+        the listing is read up front to index objects by ETag, and files
+        whose content is already in the bucket are copied, not uploaded.
+        With snapshots set, the listing comes from the manifest snapshot
+        unless full_list is set or the snapshot can not be trusted, and the
+        snapshot is brought up to date after a sync without failures.  The
+        state marker is only replaced when the sync writes or deletes keys.
+        A manifest dict is filled with the (key, etag) of the bucket as it
+        is after the sync, without listing it again.
+        Returns a SyncResult."""
         root = Path(pathname).expanduser().resolve()
         s3_bucket = self.s3.Bucket(bucket)
-        self.set_bucket_manifest(bucket)
-
-        def handle_dir(pathname):
-            """ Uploads directory and sub directories to s3 bucket."""
-            path = Path(pathname)
-            for each in path.iterdir():
-                if each.is_dir():
-                    handle_dir(each)
-                else:
-                    self.local_files.append(str(each.relative_to(root).as_posix()))
-                    self.file_upload(
-                        s3_bucket.name,
-                        str(each),
-                        str(each.relative_to(root).as_posix())
-                    )
-        handle_dir(root)
         del_list = []
+        token = None
+        if self.snapshots is not None and not full_list:
+            token = self.trusted_snapshot(bucket)
+        remote = self.remote_objects(bucket, token is None, True, token)
+        # Until this sync completes no snapshot describes the bucket.
+        if self.snapshots is not None:
+            self.snapshots.set_token(bucket, None)
+        before_write = StateMarkerGuard(self, bucket)
+        if manifest is not None:
+            remote = self.record_manifest(remote, manifest)
+        etag_index = None
+        if dedupe:
+            remote = list(remote)
+            etag_index = {}
+            for key, etag in remote:
+                etag_index.setdefault(etag, key)
 
-        for file in self.local_files:
-            try:
-                del(self.manifest[file])
-            except KeyError:
-                # File does not exist in manifest.
-                pass
-        for k in self.manifest.keys():
-            del_list.append(
-                {'Key': k},
-                )
-        [print(f'Removing {file["Key"]} from {bucket}') for file in del_list]
-        try:
-            s3_bucket.delete_objects(
-                Delete={
-                    'Objects': del_list
-                }
-            )
-        except:
+        def uploads():
+            for action in planner.plan(
+                self.metrics.timed_iter('walk', planner.walk_local(root)),
+                remote
+            ):
+                if action.kind == planner.DELETE:
+                    del_list.append(action.key)
+                elif action.kind == planner.UPLOAD:
+                    # Not in the bucket; '' keeps file_upload from looking
+                    # the key up in a manifest loaded for an earlier sync.
+                    yield action.path, action.key, ''
+                else:
+                    yield action.path, action.key, action.etag
+
+        # Wall time of the streamed walk, list, hash and upload pipeline.
+        with self.metrics.timer('uploads'):
+            result = self.upload_files(
+                s3_bucket.name, uploads(), jobs, etag_index=etag_index,
+                before_write=before_write)
+        if self.journal is not None:
+            # Failed uploads stay journaled so the next sync resumes them.
+            self.abort_stale_uploads(
+                s3_bucket.name, {key for key, _ in result.failed})
+
+        if del_list:
+            [print(f'Removing {key} from {bucket}') for key in del_list]
+            before_write()
+            failed = self.delete_keys(s3_bucket.name, del_list, jobs)
+            failed_keys = {key for key, _ in failed}
+            result.deleted = [k for k in del_list if k not in failed_keys]
+            result.failed.extend(failed)
+        else:
             print('It does not appear that any files need to be removed.')
+        if manifest is not None:
+            manifest.update(result.etags)
+            for key in result.deleted:
+                manifest.pop(key, None)
+        if self.snapshots is not None and not result.failed:
+            # A trusted snapshot of a bucket nothing was written to keeps
+            # its marker, so a no-op sync adds no versions to the bucket.
+            renew = token is None or before_write.cleared
+            if renew:
+                token = uuid.uuid4().hex
+            self.snapshots.update(bucket, result.etags, result.deleted, token)
+            if renew:
+                self.put_state_marker(bucket, token)
+        if self.etag_cache is not None:
+            self.etag_cache.save()
+        return result
@@ -1,15 +1,36 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import boto3
+from websync import config
 
 
 class SessionConfig(object):
-    """Creates a SessionConfig object
-    test
-    """
-    def __init__(self, profile):
+    """Holds settings and creates the boto3 session plus the client and
+    transfer configs built from them (see websync.config) on first use."""
+    def __init__(self, profile, settings=None):
         self.session_cfg = {}
         if profile:
             self.session_cfg['profile_name'] = profile
-        self.session = boto3.Session(**self.session_cfg)
+        self.settings = settings or config.load_settings()
+        self._session = None
+        self._client_config = None
+        self._transfer_config = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import boto3
+            self._session = boto3.Session(**self.session_cfg)
+        return self._session
+
+    @property
+    def client_config(self):
+        if self._client_config is None:
+            self._client_config = config.get_client_config(self.settings)
+        return self._client_config
+
+    @property
+    def transfer_config(self):
+        if self._transfer_config is None:
+            self._transfer_config = config.get_transfer_config(self.settings)
+        return self._transfer_config
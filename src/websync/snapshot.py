@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Snapshots of bucket listings, so a sync need not list the bucket."""
+
+import os
+import sqlite3
+import threading
+from websync import utils
+
+
+class ManifestSnapshots:
+    """Stores the sorted (key, ETag) listing of each bucket as of its last
+    sync, with the token of the state marker that sync wrote.
+
+    A snapshot is only trusted while its token matches the marker in the
+    bucket; the token is cleared first whenever the snapshot is replaced
+    or the bucket is about to change.
+    """
+
+    SCHEMA_VERSION = 1
+    BATCH_SIZE = 10000
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(utils.get_cache_dir(), 'manifests.db')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS snapshots')
+            self.db.execute('DROP TABLE IF EXISTS objects')
+            self.db.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            ' bucket TEXT PRIMARY KEY,'
+            ' token TEXT)'
+        )
+        # TEXT keys compare bytewise, the order list_objects_v2 uses.
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS objects ('
+            ' bucket TEXT,'
+            ' key TEXT,'
+            ' etag TEXT,'
+            ' PRIMARY KEY (bucket, key)) WITHOUT ROWID'
+        )
+        self.db.commit()
+
+    def get_token(self, bucket):
+        """Returns the marker token of bucket's snapshot, or None."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT token FROM snapshots WHERE bucket = ?', (bucket,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_token(self, bucket, token):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?)',
+                (bucket, token))
+            self.db.commit()
+
+    def count(self, bucket):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM objects WHERE bucket = ?', (bucket,)
+            ).fetchone()[0]
+
+    def window(self, bucket, after='', until=None, limit=-1):
+        """Returns [(key, etag)] of keys after `after`, up to and including
+        `until`, in key order."""
+        query = 'SELECT key, etag FROM objects WHERE bucket = ? AND key > ?'
+        args = [bucket, after]
+        if until is not None:
+            query += ' AND key <= ?'
+            args.append(until)
+        query += ' ORDER BY key LIMIT ?'
+        args.append(limit)
+        with self.lock:
+            return self.db.execute(query, args).fetchall()
+
+    def objects(self, bucket):
+        """Yields (key, etag) for bucket in key order, one batch at a time."""
+        after = ''
+        while True:
+            rows = self.window(bucket, after, limit=self.BATCH_SIZE)
+            yield from rows
+            if len(rows) < self.BATCH_SIZE:
+                return
+            after = rows[-1][0]
+
+    def sample(self, bucket, n):
+        """Returns up to n keys of bucket picked at random."""
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                'SELECT key FROM objects WHERE bucket = ?'
+                ' ORDER BY RANDOM() LIMIT ?', (bucket, n))]
+
+    def record(self, bucket, objects):
+        """Yields from the (key, etag) iterator objects while storing them as
+        bucket's new snapshot, without a token."""
+        with self.lock:
+            self.db.execute('DELETE FROM snapshots WHERE bucket = ?', (bucket,))
+            self.db.execute('DELETE FROM objects WHERE bucket = ?', (bucket,))
+            self.db.commit()
+        batch = []
+        for key, etag in objects:
+            batch.append((bucket, key, etag))
+            if len(batch) >= self.BATCH_SIZE:
+                self._insert(batch)
+                batch = []
+            yield key, etag
+        self._insert(batch)
+
+    def _insert(self, rows):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', rows)
+            self.db.commit()
+
+    def update(self, bucket, etags, deleted, token):
+        """Applies a sync's written keys and ETags and its deleted keys to
+        bucket's snapshot, and trusts it under token."""
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                ((bucket, key, etag) for key, etag in etags.items()))
+            self.db.executemany(
+                'DELETE FROM objects WHERE bucket = ? AND key = ?',
+                ((bucket, key) for key in deleted))
+            self.db.execute(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?)',
+                (bucket, token))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
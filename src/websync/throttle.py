@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Limits the bytes and requests per second a sync sends to s3.
+
+One Throttle is shared by every thread of a run, so the limits hold for
+all concurrent transfers together.  When s3 answers SlowDown the request
+rate is halved, then raised again while no more SlowDowns arrive.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """Thread safe token bucket refilled at rate tokens per second.
+
+    A caller takes its tokens at once, running into debt if needed, and
+    sleeps until the debt is paid, so callers are served in turn.  A rate
+    of None never waits.
+    """
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Changes the rate.  Up to one second of tokens can be saved."""
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            if rate is not None:
+                self.tokens = min(self.tokens, rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Takes amount tokens.  Returns seconds waited for them."""
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle:
+    """Bandwidth and request rate limits for s3 clients and transfers.
+
+    instrument() makes every request of a client, retries included, wait
+    for a request token; consume_bytes() is a transfer progress callback
+    that waits for a token per byte read.  With adaptive set, SlowDown
+    responses lower the request rate, even when no limit was given.
+    """
+
+    # Request rate is multiplied by BACKOFF on SlowDown, at most once per
+    # COOLDOWN seconds, and by RECOVERY for each COOLDOWN without one.
+    BACKOFF = 0.5
+    RECOVERY = 1.2
+    COOLDOWN = 1.0
+    MIN_REQUEST_RATE = 1.0
+    SLOWDOWN_CODES = ('SlowDown', '503 SlowDown', 'RequestLimitExceeded')
+
+    def __init__(self, bytes_per_second=None, requests_per_second=None,
+                 adaptive=True, metrics=None):
+        self.bytes = TokenBucket(bytes_per_second)
+        self.requests = TokenBucket(requests_per_second)
+        self.max_request_rate = requests_per_second
+        self.request_rate = requests_per_second
+        self.adaptive = adaptive
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # Send times of the last second of requests, to measure the rate
+        # s3 pushed back on when no limit was set.
+        self.sent = deque()
+        self.peak_rate = None
+        self.changed = 0.0
+
+    def instrument(self, client):
+        events = client.meta.events
+        events.register('before-send.s3', self._before_send)
+        if self.adaptive:
+            events.register('needs-retry.s3', self._needs_retry)
+
+    def consume_bytes(self, amount):
+        """Waits until amount bytes may be sent.  Negative amounts, sent
+        when a transfer rewinds for a retry, are ignored."""
+        if amount > 0:
+            self._record('bytes', self.bytes.acquire(amount))
+
+    def _record(self, limit, waited):
+        if waited and self.metrics is not None:
+            self.metrics.incr('throttled_seconds', waited, limit=limit)
+
+    def _before_send(self, **kwargs):
+        if self.adaptive:
+            self._track_request()
+        self._record('requests', self.requests.acquire())
+
+    def _track_request(self):
+        now = time.monotonic()
+        with self.lock:
+            self.sent.append(now)
+            while self.sent[0] < now - 1.0:
+                self.sent.popleft()
+            if self.request_rate is None \
+                    or self.request_rate == self.max_request_rate \
+                    or now - self.changed < self.COOLDOWN:
+                return
+            rate = self.request_rate * self.RECOVERY
+            ceiling = self.max_request_rate or self.peak_rate
+            if rate >= ceiling:
+                rate = self.max_request_rate
+            self._set_request_rate(rate, now)
+
+    def _needs_retry(self, response=None, **kwargs):
+        if response is None:
+            return None
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code')
+        if code in self.SLOWDOWN_CODES or http_response.status_code == 503:
+            self.slow_down()
+        return None
+
+    def slow_down(self):
+        """Lowers the request rate after s3 answered SlowDown."""
+        now = time.monotonic()
+        with self.lock:
+            # Requests in flight fail together, back off once for them.
+            if now - self.changed < self.COOLDOWN:
+                return
+            current = self.request_rate or max(len(self.sent), 1)
+            if self.request_rate is None:
+                self.peak_rate = current
+            rate = max(current * self.BACKOFF, self.MIN_REQUEST_RATE)
+            self._set_request_rate(rate, now)
+        if self.metrics is not None:
+            self.metrics.incr('slowdowns')
+        print(f'S3 asked to slow down, limiting to {rate:.0f} requests/s.')
+
+    def _set_request_rate(self, rate, now):
+        self.request_rate = rate
+        self.requests.set_rate(rate)
+        self.changed = now
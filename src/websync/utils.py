@@ -1,6 +1,9 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import time
 from collections import namedtuple
 
 Endpoint = namedtuple('Endpoint', ['name', 'site', 'dnszone'])
@@ -48,3 +51,42 @@ def region_check(region):
     if region in region_to_endpoint:
         return True
     return False
+
+
+def get_cache_dir():
+    """Returns websync cache directory, creating it if needed."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'websync')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def read_json_cache(name, ttl):
+    """Returns data cached under name if younger than ttl seconds."""
+    if not ttl:
+        return None
+    path = os.path.join(get_cache_dir(), name)
+    try:
+        if time.time() - os.path.getmtime(path) < ttl:
+            with open(path) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def write_json_cache(name, data):
+    """Caches data under name, replacing any earlier copy atomically."""
+    path = os.path.join(get_cache_dir(), name)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, default=str)
+    os.replace(tmp, path)
+
+
+def remove_json_cache(name):
+    try:
+        os.remove(os.path.join(get_cache_dir(), name))
+    except FileNotFoundError:
+        pass
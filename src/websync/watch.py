@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Keeps a bucket in sync with a directory while files change.
+
+After one full sync the bucket's keys and ETags are held in memory, and
+each burst of file events only hashes, uploads or deletes the paths it
+touched.  Events come from inotify and friends through watchdog
+(pip install watchdog) or, without it, from polling the tree's stat data.
+"""
+
+import bisect
+import os
+import queue
+import time
+from pathlib import Path
+from websync import planner
+from websync.s3bucket import StateMarkerGuard
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class PollingSource:
+    """Finds changed files by comparing stat snapshots of the tree."""
+
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """Returns {path: (size, mtime_ns)} of files under root."""
+        snapshot = {}
+        stack = [self.root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            stack.append(entry.path)
+                            continue
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        return snapshot
+
+    def get(self, timeout=None):
+        """Returns the set of paths changed since the last call, waiting up
+        to timeout seconds, or forever, for one."""
+        start = time.monotonic()
+        while True:
+            time.sleep(self.interval if timeout is None
+                       else min(self.interval, timeout))
+            snapshot = self.scan()
+            changed = {
+                path for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            }
+            self.snapshot = snapshot
+            if changed or (timeout is not None
+                           and time.monotonic() - start >= timeout):
+                return changed
+
+    def close(self):
+        pass
+
+
+class _EventQueue(FileSystemEventHandler):
+    """Queues the paths of watchdog events."""
+
+    # Reading a file does not change it.
+    IGNORED = ('opened', 'closed_no_write')
+    # A directory is modified whenever an entry in it is added, removed or
+    # renamed, which the entry reports itself.
+    IGNORED_DIRECTORY = ('modified',)
+
+    def __init__(self):
+        super().__init__()
+        self.queue = queue.Queue()
+
+    def on_any_event(self, event):
+        if event.event_type in self.IGNORED or (
+                event.is_directory
+                and event.event_type in self.IGNORED_DIRECTORY):
+            return
+        self.queue.put(os.fsdecode(event.src_path))
+        dest = getattr(event, 'dest_path', '')
+        if dest:
+            self.queue.put(os.fsdecode(dest))
+
+
+class WatchdogSource:
+    """Reports changed paths from file system events."""
+
+    def __init__(self, root):
+        if Observer is None:
+            raise ImportError('watchdog is not installed: pip install watchdog')
+        self.events = _EventQueue()
+        self.observer = Observer()
+        self.observer.schedule(self.events, str(root), recursive=True)
+        self.observer.start()
+
+    def get(self, timeout=None):
+        """Returns the set of paths changed since the last call, waiting up
+        to timeout seconds, or forever, for one."""
+        try:
+            changed = {self.events.queue.get(timeout=timeout)}
+        except queue.Empty:
+            return set()
+        while True:
+            try:
+                changed.add(self.events.queue.get_nowait())
+            except queue.Empty:
+                return changed
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+class SiteWatcher:
+    """Re-syncs the paths that change under root to bucket.
+
+    Events are collected until none arrive for `debounce` seconds, or for
+    at most `max_delay` seconds, so a build writing many files is synced
+    as one batch.  on_change is called with the SyncResult of every batch
+    that changed the bucket.  Paths that fail are retried with the next
+    batch.
+    """
+
+    def __init__(self, bucket_manager, root, bucket, jobs=8, debounce=0.5,
+                 max_delay=5.0, poll_interval=1.0, polling=False,
+                 on_change=None):
+        self.bucket_manager = bucket_manager
+        self.root = Path(root).expanduser().resolve()
+        self.bucket = bucket
+        self.jobs = jobs
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.polling = polling or Observer is None
+        self.on_change = on_change
+        self.manifest = {}
+        # Sorted keys of manifest, to find the keys under a prefix.
+        self.keys = []
+        self.retry = set()
+        self.source = None
+        self.before_write = None
+
+    def start(self):
+        """Starts watching, then syncs the whole tree and loads the bucket's
+        keys.  Watching first means no change made during the sync is
+        missed.  Returns the SyncResult of the full sync."""
+        if self.polling:
+            self.source = PollingSource(str(self.root), self.poll_interval)
+        else:
+            self.source = WatchdogSource(self.root)
+        self.manifest = {}
+        result = self.bucket_manager.sync_bucket(
+            self.root, self.bucket, self.jobs, manifest=self.manifest)
+        self.keys = sorted(self.manifest)
+        # Snapshots of the bucket go stale with the first change watched.
+        self.before_write = StateMarkerGuard(self.bucket_manager, self.bucket)
+        return result
+
+    def collect(self):
+        """Waits for a burst of changes.  Returns the set of paths."""
+        changed = self.source.get(self.poll_interval if self.retry else None)
+        deadline = time.monotonic() + self.max_delay
+        while time.monotonic() < deadline:
+            more = self.source.get(self.debounce)
+            if not more:
+                break
+            changed |= more
+        changed |= self.retry
+        self.retry = set()
+        return changed
+
+    def get_key(self, path):
+        """Returns the key of path, or None if it is not under root."""
+        try:
+            key = Path(path).relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+        return None if key == '.' else key
+
+    def keys_under(self, prefix):
+        """Yields keys of manifest starting with prefix."""
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            yield self.keys[i]
+            i += 1
+
+    def plan(self, paths):
+        """Returns ([(path, key, remote etag)], [key]) of files to upload
+        and keys to delete for changed paths."""
+        files = {}
+        deletes = set()
+        for path in paths:
+            key = self.get_key(path)
+            if key is None:
+                continue
+            if os.path.isfile(path):
+                files[key] = path
+                continue
+            # Only created and moved directories are reported, and a
+            # directory moved in reports none of the files inside it.
+            if os.path.isdir(path):
+                for sub_key, sub_path in planner.walk_local(path, key + '/'):
+                    files[sub_key] = sub_path
+            # Likewise a removed or moved away directory only reports
+            # itself, so look for keys below it that are gone too.
+            if key in self.manifest:
+                deletes.add(key)
+            deletes.update(
+                k for k in self.keys_under(key + '/')
+                if not os.path.isfile(self.root / k)
+            )
+        uploads = [
+            (path, key, self.manifest.get(key, ''))
+            for key, path in sorted(files.items())
+        ]
+        return uploads, sorted(deletes - files.keys())
+
+    def apply(self, paths):
+        """Syncs changed paths.  Returns a SyncResult."""
+        bucket_manager = self.bucket_manager
+        uploads, deletes = self.plan(paths)
+        with bucket_manager.metrics.timer('watch_batch'):
+            result = bucket_manager.upload_files(
+                self.bucket, uploads, self.jobs,
+                before_write=self.before_write)
+            if deletes:
+                self.before_write()
+                failed = bucket_manager.delete_keys(
+                    self.bucket, deletes, self.jobs)
+                failed_keys = {key for key, _ in failed}
+                result.deleted = [k for k in deletes if k not in failed_keys]
+                result.failed.extend(failed)
+        bucket_manager.metrics.incr('watch_batches')
+
+        for key, etag in result.etags.items():
+            if key not in self.manifest:
+                bisect.insort(self.keys, key)
+            self.manifest[key] = etag
+        for key in result.deleted:
+            if self.manifest.pop(key, None) is not None:
+                del self.keys[bisect.bisect_left(self.keys, key)]
+        for key, _ in result.failed:
+            self.retry.add(str(self.root / key))
+        if bucket_manager.etag_cache is not None:
+            bucket_manager.etag_cache.save()
+        return result
+
+    def run(self):
+        """Syncs changes until interrupted."""
+        self.start()
+        mode = 'polling' if self.polling else 'file system events'
+        print(f'Watching {self.root} for changes ({mode}).')
+        try:
+            while True:
+                paths = self.collect()
+                start = time.perf_counter()
+                result = self.apply(paths)
+                print(f'Synced {len(paths)} changed path(s) in '
+                      f'{time.perf_counter() - start:.1f}s: '
+                      f'{len(result.uploaded)} uploaded, '
+                      f'{len(result.deleted)} deleted, '
+                      f'{len(result.failed)} failed.')
+                if result.changed and self.on_change is not None:
+                    # Keep watching if e.g. an invalidation is refused.
+                    try:
+                        self.on_change(result)
+                    except Exception as e:
+                        print(f'Failed to handle changes: {e}')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None